@@ -3,7 +3,13 @@ import time
 import logging
 
 from persistentstore import PersistentStore
+from imagecache import ImageCache
+from metadatacache import MetadataCache
+from searchcache import SearchCache
+from tagprefetcher import TagPrefetcher
 from asyncioloop import AsyncIOLoop
+from eventdispatcher import EventDispatcher
+from statesnapshot import StateSnapshot
 from websocket_registry import WebSocketRegistry
 from wsmessage import *
 
@@ -11,40 +17,52 @@ from Phidgets.PhidgetException import PhidgetErrorCodes, PhidgetException
 from Phidgets.Events.Events import AttachEventArgs, DetachEventArgs, ErrorEventArgs, OutputChangeEventArgs, TagEventArgs
 from Phidgets.Devices.RFID import RFID, RFIDTagProtocol
 
-from web import WebApplication
+from web import WebApplication, search_result_to_dict
 from asyncsession import SpotifyAsyncSessionManager
+from audiosink import create_audio_sink
 import tornado.web
+import tornado.ioloop
 
 logger = logging.getLogger(__name__)
 
-class RfidReader(object):
-    def __init__(self, name, version, serial_no):
-        self.name = name
-        self.version = version
-        self.serial_no = serial_no
-
-
 class AppContainer(object):
 
     def __init__(self, config):
         self.config = config
         self.store = PersistentStore(self.config['dbfilename'])
+        self.image_cache = ImageCache(self.config['imagecache_dir'], self.config['imagecache_size'])
+        self.metadata_cache = MetadataCache(self.config['metadatacache_size'], self.config['metadatacache_ttl'])
 
 
-        self.spotify_session = SpotifyAsyncSessionManager(useragent="SpotifyThings")
+        audio_sink = create_audio_sink(self.config['audio_sink'], **self.config['audio_sink_options'])
+
+        self.spotify_session = SpotifyAsyncSessionManager(useragent="SpotifyThings", audio_sink=audio_sink, measure_music_delivery=self.config['measure_music_delivery'])
         self.spotify_session.player_state_changed += self.__player_state_changed
         self.spotify_session.current_track_changed += self.__current_track_changed
-        self.spotify_session.playback_progress += self.__playback_progress_event
         self.spotify_session.playqueue_changed += self.__playqueue_changed_event
         self.spotify_session.login_state_changed += self.__login_state_changed_event
         self.spotify_session.password_blob_changed += self.__login_password_blob_changed
 
+        self.search_cache = SearchCache(self.spotify_session, search_result_to_dict, self.config['searchcache_queries'], self.config['searchcache_ttl'])
+        self.tag_prefetcher = TagPrefetcher(self.store, self.spotify_session, self.config['prefetch_interval'])
+
         self.wsregistry = WebSocketRegistry();
         self.wsregistry.on_new_client += self.__on_new_client
 
+        # latest state messages, sent to new clients without asking the spotify session
+        self.snapshot = StateSnapshot()
+        self.is_credentials_stored = False
+
         self.webapp = WebApplication(self)
         self.asyncioloop = AsyncIOLoop()
 
+        # events raised on spotify, rfid and audio threads reach the websockets on the IOLoop
+        self.dispatcher = EventDispatcher(tornado.ioloop.IOLoop.instance())
+
+        # playback progress is read from the audio clock instead of pushed by the audio thread
+        self.playback_progress_callback = tornado.ioloop.PeriodicCallback(self.__poll_playback_progress, self.config['playback_progress_interval'] * 1000)
+        self.last_playback_progress = None
+
         self.attached_rfid_readers = dict()
 
         self.rfid = RFID()
@@ -56,57 +74,73 @@ class AppContainer(object):
 
 
 
+    def __broadcast(self, wstype, msg, coalesce=True):
+        # messages are built on the raising thread, only the write is moved to the IOLoop
+        self.dispatcher.dispatch((wstype, msg['type']) if coalesce else None, self.wsregistry.broadcast, wstype, msg, coalesce)
+
+    def __publish_state(self, msg):
+        self.snapshot.update(msg)
+        self.__broadcast('app', msg)
+
+    def __seed_snapshot(self):
+        def player_state_handler(current_track, track_playback_time, player_state):
+            self.snapshot.update(PlayerStateMessage(player_state))
+            self.snapshot.update(PlayerCurrentTrackMessage(current_track))
+            self.snapshot.update(PlayerPlaybackProgressMessage(int(track_playback_time)))
+
+        def login_state_handler(is_logged_in, login_error, current_user):
+            self.snapshot.update(SpotifyLoginStateMessage(is_logged_in, login_error, current_user))
+
+        self.spotify_session.get_player_state(player_state_handler)
+        self.spotify_session.get_login_state(login_state_handler)
+
+        self.snapshot.update(RfidReaderUpdatedMessage(self.attached_rfid_readers))
+        self.snapshot.update(SpotifyCredentialStoredMessage(self.is_credentials_stored))
+
     # player events
     def __player_state_changed(self, state):
-        self.wsregistry.broadcast('app', PlayerStateMessage(state))
+        self.__publish_state(PlayerStateMessage(state))
 
     def __current_track_changed(self, track):
-        self.wsregistry.broadcast('app', PlayerCurrentTrackMessage(track))
+        self.__publish_state(PlayerCurrentTrackMessage(track))
+
+    def __poll_playback_progress(self):
+        if not self.spotify_session.is_playing:
+            return
 
-    def __playback_progress_event(self, playback_time):
-        self.wsregistry.broadcast('app', PlayerPlaybackProgressMessage(int(playback_time)))
+        playback_time = int(self.spotify_session.get_playback_time())
 
-    def __playqueue_changed_event(self):
-        self.wsregistry.broadcast('app', PlayerQueueModifiedMessage())
+        if playback_time != self.last_playback_progress:
+            self.last_playback_progress = playback_time
+
+            msg = PlayerPlaybackProgressMessage(playback_time)
+            self.snapshot.update(msg)
+            self.wsregistry.broadcast('app', msg)
+
+    def __playqueue_changed_event(self, from_version, version, changes):
+        # changes build on each other and must not be coalesced
+        self.__broadcast('app', PlayerQueueModifiedMessage(from_version, version, changes), coalesce=False)
 
     # app event
     def __login_state_changed_event(self, is_logged_in, login_error, current_user):
-        self.wsregistry.broadcast('app', SpotifyLoginStateMessage(is_logged_in, login_error, current_user))
+        self.__publish_state(SpotifyLoginStateMessage(is_logged_in, login_error, current_user))
+
+        # resolve tag mapped links as soon as possible
+        if is_logged_in:
+            self.tag_prefetcher.refresh()
 
     def __login_password_blob_changed(self, username, password_blob):
         self.store.set_config('spotify.username', username)
         self.store.set_config('spotify.password_blob', password_blob)
 
-        self.wsregistry.broadcast('app', SpotifyCredentialStoredMessage(self.store.get_config('spotify.password_blob') is not None))
+        self.is_credentials_stored = password_blob is not None
+        self.__publish_state(SpotifyCredentialStoredMessage(self.is_credentials_stored))
 
     # websocket events
     def __on_new_client(self, wstype, ws):
-        def spotify_state_handler(current_track, track_playback_time, player_state):
-            # send player state
-            ws.write_message(PlayerStateMessage(player_state))
-
-            # send current track
-            ws.write_message(PlayerCurrentTrackMessage(current_track))
-
-            # send playback progress
-            ws.write_message(PlayerPlaybackProgressMessage(int(track_playback_time)))
-
-        def spotify_login_state_handler(is_logged_in, login_error, current_user):
-            # send login state message
-            ws.write_message(SpotifyLoginStateMessage(is_logged_in, login_error, current_user))
-
         if wstype == "app":
-            # request spotify state
-            self.spotify_session.get_player_state(spotify_state_handler)
-
-            # request login state
-            self.spotify_session.get_login_state(spotify_login_state_handler)
-
-            # send message with currently attched rfid readers
-            ws.write_message(RfidReaderUpdatedMessage(self.attached_rfid_readers))
-
-            # send message with credentials stored status
-            ws.write_message(SpotifyCredentialStoredMessage(self.store.get_config('spotify.password_blob') is not None))
+            # send player, login, rfid reader and credentials state in one frame
+            self.wsregistry.send_frame(ws, 'snapshot', self.snapshot.get_frame())
 
 
     # rfid events
@@ -123,7 +157,7 @@ class AppContainer(object):
         self.attached_rfid_readers[reader.serial_no] = reader
 
         # notify clients
-        self.wsregistry.broadcast('app', RfidReaderUpdatedMessage(self.attached_rfid_readers))
+        self.__publish_state(RfidReaderUpdatedMessage(self.attached_rfid_readers))
 
         logger.info('RFID reader %s Attached', device.getSerialNum())
 
@@ -136,7 +170,7 @@ class AppContainer(object):
         del self.attached_rfid_readers[serial_no]
 
         # notify clients
-        self.wsregistry.broadcast('app', RfidReaderUpdatedMessage(self.attached_rfid_readers))
+        self.__publish_state(RfidReaderUpdatedMessage(self.attached_rfid_readers))
 
         logger.info('RFID reader %s Deteched', device.getSerialNum())
 
@@ -159,7 +193,9 @@ class AppContainer(object):
         tagmapping = self.store.find_by_tagid(e.tag)
 
         # broadcast to any listeners
-        any_listeners = self.wsregistry.broadcast('rfid', RfidTagReadMessage(e.tag, tagmapping))
+        any_listeners = self.wsregistry.has_clients('rfid')
+        if any_listeners:
+            self.__broadcast('rfid', RfidTagReadMessage(e.tag, tagmapping), coalesce=False)
 
         # no listeners and resource was mapped, play resource
         if not any_listeners and tagmapping:
@@ -176,7 +212,18 @@ class AppContainer(object):
         self.store.delete_configs(['spotify.username', 'spotify.password_blob'])
 
         # notify clients
-        self.wsregistry.broadcast('app', SpotifyCredentialStoredMessage(self.store.get_config('spotify.password_blob') is not None))
+        self.is_credentials_stored = False
+        self.__publish_state(SpotifyCredentialStoredMessage(self.is_credentials_stored))
+
+    def get_stats(self):
+        # must be called on the IOLoop, the websocket registry is only used there
+        return dict(
+            store=self.store.connection_stats(),
+            metadata_cache=self.metadata_cache.stats(),
+            search_cache=self.search_cache.stats(),
+            spotify_session=self.spotify_session.get_stats(),
+            dispatcher=self.dispatcher.stats(),
+            websockets=self.wsregistry.stats())
 
 
 
@@ -187,6 +234,10 @@ class AppContainer(object):
         logger.info('Initializing store')
         self.store.initialize()
 
+        # initialize image cache
+        logger.info('Initializing image cache')
+        self.image_cache.initialize()
+
         # start spotify
         logger.info('Starting spotify session')
         self.spotify_session.start()
@@ -195,6 +246,10 @@ class AppContainer(object):
         username = self.store.get_config('spotify.username')
         password_blob = self.store.get_config('spotify.password_blob')
 
+        # initial state for connecting clients
+        self.is_credentials_stored = password_blob is not None
+        self.__seed_snapshot()
+
         if username and password_blob:
             logger.info('Logging in with username %s', username)
             self.spotify_session.login(username, None, False, password_blob)
@@ -203,6 +258,9 @@ class AppContainer(object):
         listen_port = self.config['listen_port']
         logger.info('Starting web application, listening on port %s', listen_port)
         self.webapp.listen(listen_port)
+        self.tag_prefetcher.start()
+        self.playback_progress_callback.start()
+        self.wsregistry.start()
         self.asyncioloop.start()
 
         # start rfid
@@ -221,11 +279,18 @@ class AppContainer(object):
         # stop webapp
         logger.info('Stopping web application')
         self.asyncioloop.stop()
+        self.tag_prefetcher.stop()
+        self.playback_progress_callback.stop()
+        self.wsregistry.stop()
 
         # stop spotify
         logger.info('Stopping Spotify session')
         self.spotify_session.stop()
 
+        # close store
+        logger.info('Closing store')
+        self.store.close()
+
         logger.info('Appcontainer stopped')
 
 
@@ -8,93 +8,192 @@ import binascii
 import logging
 import time
 import os
+import functools
+import collections
 
 import spotify
 from spotify import Settings, AlbumBrowser, Link, SpotifyError
 from playqueue import PlayeQueueManager
 from event import EventHook
 from eventsink import EventSink
-from alsaplayer import AlsaPlayer
+from singleflight import SingleFlight
+from metadatawaiters import MetadataWaiterRegistry
+from models import LinkPreview
+from audiobuffer import PcmRingBuffer, AudioOutputThread, MusicDeliveryMeter
 
 logger = logging.getLogger(__name__)
 
+# command priorities, lanes with a lower value are served first
+PRIORITY_CONTROL = 0
+PRIORITY_PLAYBACK = 1
+PRIORITY_METADATA = 2
+PRIORITY_IMAGE = 3
+PRIORITY_BACKGROUND = 4
 
-class AsyncLoadedItem(object):
 
-    def __init__(self, obj, is_loaded, callback):
-        self.obj = obj
-        self.is_loaded = is_loaded
-        self.callback = callback
+class PlayQueueEdit(object):
 
-    def check_is_loaded(self):
-        if self.is_loaded(self.obj):
-            self.callback(self.obj)
-            return True
+    __slots__ = ('requested', 'apply', 'abandon')
 
-        return False
+    def __init__(self, abandon):
+        self.requested = time.time()
 
-class LinkPreview(object):
+        # set once the edit is ready to be applied
+        self.apply = None
+        self.abandon = abandon
 
-    def __init__(self, name, type, image_id, uri):
-        self.name = name
-        self.type = type
-        self.image_id = image_id
-        self.uri = uri
+
+class PriorityCommandQueue(object):
+
+    def __init__(self, starvation_timeout):
+        self.starvation_timeout = starvation_timeout
+        self.lanes = [collections.deque() for priority in range(PRIORITY_BACKGROUND + 1)]
+        self.lanes_lock = threading.Lock()
+
+    def put(self, item, priority):
+        with self.lanes_lock:
+            self.lanes[priority].append((time.time(), item))
+
+    def get_nowait(self, max_priority=PRIORITY_BACKGROUND):
+        with self.lanes_lock:
+            waiting_lanes = [lane for lane in self.lanes[:max_priority + 1] if lane]
+            if not waiting_lanes:
+                raise Queue.Empty
+
+            # a lane whose oldest command has waited too long is served before higher priority lanes
+            starved_before = time.time() - self.starvation_timeout
+            starved_lanes = [lane for lane in waiting_lanes if lane[0][0] <= starved_before]
+
+            if starved_lanes:
+                lane = min(starved_lanes, key=lambda lane: lane[0][0])
+            else:
+                lane = waiting_lanes[0]
+
+            enqueued, item = lane.popleft()
+            return item
+
+    def qsize(self):
+        with self.lanes_lock:
+            return sum(len(lane) for lane in self.lanes)
 
 
 class EventThreadState(object):
 
-    def __init__(self):
+    def __init__(self, max_concurrent_commands, command_timeout):
         self.timeout = 0
-        self.current_command = None
-        self.command_in_progress = threading.Event()
+        self.max_concurrent_commands = max_concurrent_commands
+        self.command_timeout = command_timeout
+        self.last_command_id = 0
+        self.commands_in_progress = dict()
+        self.commands_lock = threading.Lock()
+
+    def begin_cmd(self, cmd_name, timeout=None):
+        deadline = time.time() + (timeout or self.command_timeout)
+
+        with self.commands_lock:
+            self.last_command_id += 1
+            cmd_id = self.last_command_id
+            self.commands_in_progress[cmd_id] = (cmd_name, deadline)
+
+        logger.debug("Starting command: {0}".format(cmd_name))
+
+        return cmd_id
 
-    def begin_cmd(self, cmd_name):
-        self.current_command = cmd_name
-        self.command_in_progress.set()
 
-        logger.debug("Starting command: {0}".format(self.current_command))
+    def end_cmd(self, cmd_id):
+        with self.commands_lock:
+            command = self.commands_in_progress.pop(cmd_id, None)
 
+        # command has already been ended or has expired
+        if command is None:
+            return False
 
-    def end_cmd(self):
-        logger.debug("Command: {0} DONE".format(self.current_command))
+        logger.debug("Command: {0} DONE".format(command[0]))
+        return True
 
-        self.current_command = None
-        self.command_in_progress.clear()
+    def expire_cmds(self):
+        now = time.time()
 
+        with self.commands_lock:
+            expired = [(cmd_id, cmd_name) for cmd_id, (cmd_name, deadline) in self.commands_in_progress.iteritems() if deadline <= now]
+
+            for cmd_id, cmd_name in expired:
+                del self.commands_in_progress[cmd_id]
+
+        for cmd_id, cmd_name in expired:
+            logger.warning("Command: {0} timed out".format(cmd_name))
+
+        return len(expired) > 0
+
+    def can_begin_cmd(self):
+        with self.commands_lock:
+            return len(self.commands_in_progress) < self.max_concurrent_commands
 
     def is_cmd_inprogress(self):
-        return self.command_in_progress.is_set()
+        with self.commands_lock:
+            return len(self.commands_in_progress) > 0
+
+    def get_wait_timeout(self):
+        with self.commands_lock:
+            if not self.commands_in_progress:
+                return self.timeout
+
+            next_deadline = min(deadline for cmd_name, deadline in self.commands_in_progress.itervalues())
+
+        # wake up in time for process events or for the first command to expire, whichever comes first
+        return max(0, min(self.timeout, next_deadline - time.time()))
 
 
 
 
 class SpotifyEventThread(threading.Thread):
 
-    def __init__(self, session):
+    def __init__(self, session, max_concurrent_commands, command_timeout, starvation_timeout):
         threading.Thread.__init__(self, name="async_event_loop")
         self.session = session
+        self.max_concurrent_commands = max_concurrent_commands
+        self.command_timeout = command_timeout
         self.ctrlqueue = Queue.Queue()
-        self.cmdqueue = Queue.Queue()
+        self.cmdqueue = PriorityCommandQueue(starvation_timeout)
+        self.events_processed = EventHook()
 
     def run(self):
         logger.debug('Started Spotify event loop')
 
         running = True
-        state = EventThreadState()
-
-        def command_done():
-            # no command is in progress
-            state.end_cmd()
+        state = EventThreadState(self.max_concurrent_commands, self.command_timeout)
 
-            # check if there are more command that awaits execution
-            self.check_cmd()
+        def command_done(cmd_id):
+            # release the slot held by the command, callbacks of expired commands are ignored
+            if state.end_cmd(cmd_id):
+                # check if there are more command that awaits execution
+                self.check_cmd()
 
         def do_process_events():
             state.timeout = self.session.process_events() / 1000.0
             if state.is_cmd_inprogress():
-                logger.debug("Processed events, command {0} still executing".format(state.current_command))
+                logger.debug("Processed events, commands still executing")
+
+            self.events_processed.fire()
 
+        def begin_cmds():
+            # start as many commands as allowed to be in progress at the same time
+            while True:
+                # control commands never wait for a callback, they may start even when all slots are taken
+                max_priority = PRIORITY_BACKGROUND if state.can_begin_cmd() else PRIORITY_CONTROL
+
+                try:
+                    command, timeout = self.cmdqueue.get_nowait(max_priority)
+                except Queue.Empty:
+                    break
+
+                cmd_id = state.begin_cmd(command.__name__, timeout)
+                try:
+                    command(self.session, functools.partial(command_done, cmd_id))
+                except:
+                    # when error, always make sure that command is considered done
+                    command_done(cmd_id)
+                    raise
 
 
         while running:
@@ -102,29 +201,23 @@ class SpotifyEventThread(threading.Thread):
 
                 try:
 
-                    ctrl_msg = self.ctrlqueue.get(timeout=state.timeout)
+                    ctrl_msg = self.ctrlqueue.get(timeout=state.get_wait_timeout())
 
                     if ctrl_msg == 'process_events':
                         do_process_events()
                     elif ctrl_msg == 'terminate':
                         logger.debug('Terminating Spotify event loop')
                         running = False
-                    elif ctrl_msg == 'check_cmd' and not state.is_cmd_inprogress():
-                        # try get command
-                        command = self.cmdqueue.get_nowait()
-
-                        # signal command in progress so that no new commands will be executed
-                        state.begin_cmd(command.__name__)
-                        try:
-                            command(self.session, command_done)
-                        except:
-                            # when error, always make sure that command is considered done
-                            command_done()
-                            raise
+                    elif ctrl_msg == 'check_cmd':
+                        begin_cmds()
 
                 except Queue.Empty:
                     do_process_events()
 
+                # free slots held by commands whose callback never arrived
+                if state.expire_cmds():
+                    begin_cmds()
+
             except exceptions.Exception as e:
                 logger.exception('Error in thread: %s', repr(e))
 
@@ -137,9 +230,9 @@ class SpotifyEventThread(threading.Thread):
     def process_events(self):
         self.ctrlqueue.put('process_events')
 
-    def enqueue_cmd(self, command_function):
-        # put command in queue
-        self.cmdqueue.put(command_function)
+    def enqueue_cmd(self, command_function, priority=PRIORITY_METADATA, timeout=None):
+        # put command in the queue of its priority lane
+        self.cmdqueue.put((command_function, timeout), priority)
 
         # notify ctrl queue that a new command has arrived
         self.check_cmd()
@@ -155,10 +248,16 @@ class SpotifyAsyncSessionManager(object):
     settings_location = 'tmp'
     application_key = None
     appkey_file = os.path.join(os.path.dirname(__file__), 'spotify_appkey.key')
+    max_concurrent_commands = 8
+    command_timeout = 30
+    command_starvation_timeout = 2
+    image_load_timeout = 5
+    metadata_load_timeout = 20
+    audio_buffer_frames = 44100
 
 
 
-    def __init__(self, useragent, proxy=None, proxy_username=None, proxy_password=None):
+    def __init__(self, useragent, audio_sink, measure_music_delivery=False, proxy=None, proxy_username=None, proxy_password=None):
 
         # Event thread
         self.event_thread = None
@@ -208,22 +307,40 @@ class SpotifyAsyncSessionManager(object):
         self.play_queue_mgr = PlayeQueueManager()
 
         # Metadata waitinglist
-        self.metadata_waiters = []
+        self.metadata_waiters = MetadataWaiterRegistry()
+
+        # Identical requests in flight share one result
+        self.single_flight = SingleFlight(self.command_timeout)
 
         # Play state
         self.is_playing = False
         self.current_track = None
-        self.track_playback_time = 0
-        self.last_track_playback_time_notified = 0
+        self.preloaded_track = None
+
+        # Play queue version last announced to clients
+        self.playqueue_version_notified = 0
+
+        # Play queue edits in the order they were requested
+        self.playqueue_edits = collections.deque()
+
+        # Latest play request, browse results of older requests are discarded
+        self.play_request_id = 0
+
+        # Tracks of links kept resolved ahead of being played, link uri -> tracks, None while resolving
+        self.prefetched_links = dict()
 
         # Audio sink
-        #self.audio = AlsaSink(backend=self)
-        self.audio = AlsaPlayer()
-        self.audio_sink_lock = threading.Lock()
+        self.audio = audio_sink
+
+        # Audio is buffered between libspotify and a dedicated output thread
+        self.audio_buffer = PcmRingBuffer(self.audio_buffer_frames)
+        self.audio_output_thread = None
+
+        # Time spent in and frames accepted by music_delivery, logged periodically when enabled
+        self.music_delivery_meter = MusicDeliveryMeter() if measure_music_delivery else None
 
         # Event notifications
         self.current_track_changed = EventHook()
-        self.playback_progress = EventHook()
         self.player_state_changed = EventHook()
         self.playqueue_changed = EventHook()
         self.login_state_changed = EventHook()
@@ -259,18 +376,15 @@ class SpotifyAsyncSessionManager(object):
 
 
     def __session_metadata_updated(self, session):
-        done = []
+        self.metadata_waiters.metadata_updated()
 
-        for index, obj in enumerate(self.metadata_waiters):
-            if obj.check_is_loaded():
-                # add to done list for deletion
-                done.append(index)
+    def __events_processed(self):
+        # check waiters once after all pending events are processed instead of once per metadata update
+        self.metadata_waiters.check_updated()
+        self.metadata_waiters.expire()
 
-                logger.debug("Metadata load detected")
-
-        # remove all waiters that are done
-        for index in reversed(done):
-            del self.metadata_waiters[index]
+        # abandons a play queue edit that is not ready in time, also when no later edit is waiting behind it
+        self.__apply_play_queue_edits()
 
 
     def __session_connection_error(self, session, error):
@@ -281,20 +395,19 @@ class SpotifyAsyncSessionManager(object):
 
     def __session_music_delivery(self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels):
         try:
-            with self.audio_sink_lock:
-                played_frames = self.audio.music_delivery(session, frames, frame_size, num_frames, sample_type, sample_rate, channels)
-
-            played_seconds = float(played_frames) / float(sample_rate)
+            # no frames signals a discontinuity, buffered audio should be discarded
+            if num_frames == 0:
+                self.audio_buffer.flush()
+                return 0
 
-            self.track_playback_time += played_seconds
+            # never wait for the audio device on libspotify's thread
+            call_started = time.time()
+            accepted_frames = self.audio_buffer.put(frames, frame_size, num_frames, sample_type, sample_rate, channels)
 
-            # only fire every  second
-            if self.track_playback_time - self.last_track_playback_time_notified >= 1:
-                self.__fire_playback_progress_event()
-                self.last_track_playback_time_notified = self.track_playback_time
-                #print 'num_frames: {0}, frame_size: {1}'.format(num_frames, frame_size)
+            if self.music_delivery_meter:
+                self.music_delivery_meter.record(num_frames, accepted_frames, time.time() - call_started)
 
-            return played_frames
+            return accepted_frames
 
         except Exception as e:
             logger.exception('Exception in music_delivery: %s', repr(e))
@@ -308,9 +421,16 @@ class SpotifyAsyncSessionManager(object):
         logger.debug('[Spotify] %s', message)
 
     def __session_end_of_track(self, session):
-        # play next track
-        if self.play_queue_mgr.move_next_track():
-            self.__reinit_current_track()
+        def end_of_track_command(session2, command_done):
+            try:
+                # play next track, without pausing in between
+                if self.play_queue_mgr.move_next_track():
+                    self.__reinit_current_track(gapless=True)
+            finally:
+                command_done()
+
+        # called from spotify internal thread, must be queued since the play queue is only changed on the event thread
+        self.event_thread.enqueue_cmd(end_of_track_command, PRIORITY_CONTROL)
 
     def __credentials_blob_updated(self, session, password_blob):
         def fire_event_command(session2, command_done):
@@ -320,25 +440,29 @@ class SpotifyAsyncSessionManager(object):
                 command_done()
 
         # called from spotify internal thread, must be queued since we access session state (username)
-        self.event_thread.enqueue_cmd(fire_event_command)
+        self.event_thread.enqueue_cmd(fire_event_command, PRIORITY_CONTROL)
 
     # Private
     def __pause_player(self):
         self.session.play(0)
+        self.audio_buffer.pause()
         self.is_playing = False
 
     def __start_player(self):
         self.session.play(1)
+        self.audio_buffer.resume()
         self.is_playing = True
 
-    def __reinit_current_track(self):
-        self.track_playback_time = 0
-        self.last_track_playback_time_notified = 0
-
-        if self.current_track:
+    def __reinit_current_track(self, gapless=False):
+        # when a track has ended the player continues straight into the next one
+        if self.current_track and not gapless:
             self.__pause_player()
+            self.audio_buffer.flush()
             self.current_track = None
 
+        # the clock restarts once the audio buffered for the previous track has played
+        self.audio_buffer.mark(0)
+
         self.current_track = self.play_queue_mgr.get_current_track()
 
 
@@ -346,20 +470,138 @@ class SpotifyAsyncSessionManager(object):
             self.session.load(self.current_track.playable())
             self.__start_player()
 
+        self.__preload_next_track()
+
         # fire event
         self.__fire_current_track_changed_event()
         self.__fire_player_state_changed_event()
+        self.__fire_playqueue_changed_event()
+
+    def __preload_next_track(self):
+        # load metadata of the track that plays next while the current one is playing
+        self.preloaded_track = self.play_queue_mgr.peek_next_track()
+
+        if self.preloaded_track and self.preloaded_track.is_loaded() != 1:
+            self.load_track(str(Link.from_track(self.preloaded_track)), lambda track: None, PRIORITY_METADATA)
+
+    def __resolve_link(self, link_uri, callback, priority):
+        # async callbacks
+        def album_loaded(browser, userdata):
+            callback(list(browser))
+
+        def playlist_loaded(playlist):
+            callback(list(playlist) if playlist else None)
+
+        def track_loaded(track):
+            callback([ track ] if track else None)
+
+        link = Link.from_string(link_uri)
+
+        if link.type() == Link.LINK_PLAYLIST:
+            self.get_playlist(link_uri, playlist_loaded, priority)
+        elif link.type() == Link.LINK_ALBUM:
+            self.browse_album(link_uri, album_loaded, priority)
+        elif link.type() == Link.LINK_TRACK:
+            self.load_track(link_uri, track_loaded, priority)
+        else:
+            callback(None)
+
+    def __prefetch_link(self, link_uri):
+        def tracks_resolved(tracks):
+            if tracks is None:
+                logger.warning('Unable to prefetch link %s', link_uri)
+                return
+
+            # forgotten while resolving
+            if link_uri not in self.prefetched_links:
+                return
+
+            self.prefetched_links[link_uri] = tracks
+
+            # warm the metadata of the first track so that it can be loaded as soon as the link is played
+            if tracks and tracks[0].is_loaded() != 1:
+                self.load_track(str(Link.from_track(tracks[0])), lambda track: None, PRIORITY_BACKGROUND)
+
+        self.prefetched_links.setdefault(link_uri, None)
+        self.__resolve_link(link_uri, tracks_resolved, PRIORITY_BACKGROUND)
 
     def __play_track_collection(self, track_collection, starting_track_uri):
         # replace queue
         self.play_queue_mgr.replace_queue(track_collection, starting_track_uri)
 
-        # start playing track
+        # start playing track, announces the new queue
         self.__reinit_current_track()
 
-        # fire playqueue event
-        self.__fire_playqueue_changed_event()
+        # add the rest of the collection while the first track plays
+        if not self.play_queue_mgr.is_populated():
+            self.__populate_play_queue(self.play_queue_mgr.generation)
+
+    def __play_queue_edited(self, current_changed):
+        if current_changed:
+            # play the track now at the current position, announces the change
+            self.__reinit_current_track()
+        else:
+            self.__preload_next_track()
+            self.__fire_playqueue_changed_event()
+
+    def __edit_play_queue(self, prepare, abandon=None):
+        # prepare(edit_ready) calls edit_ready(apply) once the edit can be applied, edits apply in the order they were requested
+        def edit_command(session, command_done):
+            try:
+                edit = PlayQueueEdit(abandon)
+                self.playqueue_edits.append(edit)
 
+                def edit_ready(apply_edit):
+                    edit.apply = apply_edit
+                    self.__apply_play_queue_edits()
+
+                try:
+                    prepare(edit_ready)
+                except Exception as e:
+                    logger.exception('Error preparing play queue edit: %s', repr(e))
+                    edit_ready(abandon or (lambda: None))
+            finally:
+                command_done()
+
+        self.event_thread.enqueue_cmd(edit_command, PRIORITY_CONTROL)
+
+    def __apply_play_queue_edits(self):
+        while self.playqueue_edits:
+            edit = self.playqueue_edits[0]
+
+            if edit.apply is not None:
+                apply_edit = edit.apply
+            elif edit.requested > time.time() - self.command_timeout:
+                # wait for the edit, the ones after it were requested against its outcome
+                return
+            else:
+                logger.warning('Play queue edit not ready after %s sec, skipped', self.command_timeout)
+                apply_edit = edit.abandon
+
+            self.playqueue_edits.popleft()
+
+            if apply_edit:
+                try:
+                    apply_edit()
+                except Exception as e:
+                    logger.exception('Error in play queue edit: %s', repr(e))
+
+    def __populate_play_queue(self, generation):
+        def populate_play_queue_command(session, command_done):
+            try:
+                # the queue was replaced since
+                if self.play_queue_mgr.generation != generation:
+                    return
+
+                is_pending = self.play_queue_mgr.populate()
+                self.__fire_playqueue_changed_event()
+
+                if is_pending:
+                    self.__populate_play_queue(generation)
+            finally:
+                command_done()
+
+        self.event_thread.enqueue_cmd(populate_play_queue_command, PRIORITY_BACKGROUND)
 
     # Events
     def __fire_player_state_changed_event(self):
@@ -371,11 +613,15 @@ class SpotifyAsyncSessionManager(object):
     def __fire_current_track_changed_event(self):
         self.current_track_changed.fire(self.current_track)
 
-    def __fire_playback_progress_event(self):
-        self.playback_progress.fire(self.track_playback_time)
-
     def __fire_playqueue_changed_event(self):
-        self.playqueue_changed.fire()
+        from_version = self.playqueue_version_notified
+        version = self.play_queue_mgr.version
+
+        if version == from_version:
+            return
+
+        self.playqueue_version_notified = version
+        self.playqueue_changed.fire(from_version, version, self.play_queue_mgr.get_changes(from_version))
 
     def __fire_login_state_changed(self):
         self.login_state_changed.fire(self.is_logged_in, self.login_error, self.session.username() if self.is_logged_in else None)
@@ -391,9 +637,13 @@ class SpotifyAsyncSessionManager(object):
         if self.event_thread is not None:
             return
 
-        self.event_thread = SpotifyEventThread(self.session)
+        self.event_thread = SpotifyEventThread(self.session, self.max_concurrent_commands, self.command_timeout, self.command_starvation_timeout)
+        self.event_thread.events_processed += self.__events_processed
         self.event_thread.start()
 
+        self.audio_output_thread = AudioOutputThread(self.audio_buffer, self.audio)
+        self.audio_output_thread.start()
+
     def stop(self):
         def logout_command(session, command_done):
             try:
@@ -403,7 +653,7 @@ class SpotifyAsyncSessionManager(object):
 
         if self.is_logged_in:
             # enqueue logout
-            self.event_thread.enqueue_cmd(logout_command)
+            self.event_thread.enqueue_cmd(logout_command, PRIORITY_PLAYBACK)
 
             # wait until logged out
             self.session_event_sink.wait_for('_manager_logged_out')
@@ -413,6 +663,22 @@ class SpotifyAsyncSessionManager(object):
         self.event_thread.join()
         self.event_thread = None
 
+        # stop audio output
+        self.audio_buffer.close()
+        self.audio_output_thread.join()
+        self.audio_output_thread = None
+        self.audio.close()
+
+    def get_playback_time(self):
+        # position of the audio currently heard, safe to call from any thread
+        return self.audio.get_playback_time()
+
+    def get_stats(self):
+        # safe to call from any thread
+        return dict(
+            single_flight=self.single_flight.stats(),
+            audio_buffer=self.audio_buffer.stats())
+
     def get_login_state(self, callback):
         def login_state_command(session, command_done):
             try:
@@ -420,7 +686,7 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(login_state_command)
+        self.event_thread.enqueue_cmd(login_state_command, PRIORITY_CONTROL)
 
 
     def login(self, username, password, remember_me, password_blob, callback = None):
@@ -443,7 +709,7 @@ class SpotifyAsyncSessionManager(object):
         self.session_event_sink.subscribe_once('logged_in', logged_in_event)
 
         # enqueue login command
-        self.event_thread.enqueue_cmd(login_command)
+        self.event_thread.enqueue_cmd(login_command, PRIORITY_PLAYBACK)
 
 
     def relogin(self):
@@ -455,14 +721,14 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(relogin_command)
+        self.event_thread.enqueue_cmd(relogin_command, PRIORITY_PLAYBACK)
 
     def get_player_state(self, callback):
         def get_player_state_command(session, command_done):
             try:
                 callback(
                     self.current_track,
-                    self.track_playback_time,
+                    self.get_playback_time(),
                     dict(
                         is_repeat_on=self.play_queue_mgr.is_repeat_on,
                         is_shuffle_on=self.play_queue_mgr.is_shuffle_on,
@@ -470,7 +736,7 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(get_player_state_command)
+        self.event_thread.enqueue_cmd(get_player_state_command, PRIORITY_CONTROL)
 
 
     def preview_link(self, uri, callback):
@@ -492,6 +758,10 @@ class SpotifyAsyncSessionManager(object):
                         uri))
 
             def track_loaded(track):
+                if not track:
+                    callback(None)
+                    return
+
                 callback(
                     LinkPreview(
                         '{0} - {1}'.format(track.artists()[0].name() if len(track.artists()) > 0 else '', track.name()),
@@ -516,7 +786,7 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(preview_link_command)
+        self.event_thread.enqueue_cmd(preview_link_command, PRIORITY_METADATA)
 
 
 
@@ -524,11 +794,20 @@ class SpotifyAsyncSessionManager(object):
     def get_playqueue(self, callback):
         def get_playqueue_command(session, command_done):
             try:
-                callback(self.play_queue_mgr.get_tracks())
+                callback(self.play_queue_mgr.get_items(), self.play_queue_mgr.version, self.play_queue_mgr.current_track_index)
+            finally:
+                command_done()
+
+        self.event_thread.enqueue_cmd(get_playqueue_command, PRIORITY_METADATA)
+
+    def get_playqueue_changes(self, since_version, callback):
+        def get_playqueue_changes_command(session, command_done):
+            try:
+                callback(self.play_queue_mgr.get_changes(since_version), self.play_queue_mgr.version)
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(get_playqueue_command)
+        self.event_thread.enqueue_cmd(get_playqueue_changes_command, PRIORITY_METADATA)
 
     def get_playlists(self, callback):
         # got container?
@@ -541,28 +820,31 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(get_playlists_command)
+        self.event_thread.enqueue_cmd(get_playlists_command, PRIORITY_METADATA)
 
-    def get_playlist(self, playlist_uri, callback):
+    def get_playlist(self, playlist_uri, callback, priority=PRIORITY_METADATA):
         # got container?
 
         if self.playlist_container == None:
             callback(None)
 
-        def get_playlist_command(session, command_done):
-            try:
+        def start_get_playlist(done, priority):
+            def get_playlist_command(session, command_done):
+                try:
 
-                playlist_link = Link.from_string(playlist_uri)
-                playlist = playlist_link.as_playlist()
-                if playlist.is_loaded() == 1:
-                    callback(playlist)
-                else:
-                    callback(None)
+                    playlist_link = Link.from_string(playlist_uri)
+                    playlist = playlist_link.as_playlist()
+                    if playlist.is_loaded() == 1:
+                        done(playlist)
+                    else:
+                        done(None)
 
-            finally:
-                command_done()
+                finally:
+                    command_done()
+
+            self.event_thread.enqueue_cmd(get_playlist_command, priority)
 
-        self.event_thread.enqueue_cmd(get_playlist_command)
+        self.single_flight.do(('get_playlist', playlist_uri), priority, start_get_playlist, callback)
 
 
 
@@ -572,6 +854,9 @@ class SpotifyAsyncSessionManager(object):
         # inner async commands
         def change_playqueue_track_command(session, command_done):
             try:
+                # supersede any play request still waiting for its browse result
+                self.play_request_id += 1
+
                 result = self.play_queue_mgr.change_track(starting_track_uri)
                 if result:
                     self.__reinit_current_track()
@@ -583,55 +868,139 @@ class SpotifyAsyncSessionManager(object):
 
 
         def play_link_command(session, command_done):
-            # async callbacks
-            def album_loaded(browser, userdata):
-                self.__play_track_collection(browser, starting_track_uri)
+            # commands complete concurrently, only the latest play request may replace the queue
+            self.play_request_id += 1
+            request_id = self.play_request_id
+
+            def play_collection(track_collection):
+                if request_id != self.play_request_id:
+                    logger.debug('Play request for %s superseded', link_uri)
+                    if callback:
+                        callback(False)
+                    return
+
+                self.__play_track_collection(track_collection, starting_track_uri)
                 if callback:
                     callback(True)
 
-            def playlist_loaded(playlist):
-                if playlist:
-                    self.__play_track_collection(playlist, starting_track_uri)
-                    if callback:
-                        callback(True)
+            def tracks_resolved(tracks):
+                if tracks is not None:
+                    play_collection(tracks)
 
                 else:
                     if callback:
                         callback(False)
 
-            def track_loaded(track):
-                self.__play_track_collection([ track ], starting_track_uri)
+            try:
+                # play right away when the tracks are already resolved
+                tracks = self.prefetched_links.get(link_uri)
+                if tracks is not None:
+                    logger.debug('Playing prefetched link %s', link_uri)
+                    play_collection(tracks)
+                else:
+                    self.__resolve_link(link_uri, tracks_resolved, PRIORITY_PLAYBACK)
+
+            finally:
+                command_done()
+
+        if link_uri == 'playqueue':
+            self.event_thread.enqueue_cmd(change_playqueue_track_command, PRIORITY_CONTROL)
+        else:
+            self.event_thread.enqueue_cmd(play_link_command, PRIORITY_PLAYBACK)
+
+
+
+    def insert_into_playqueue(self, link_uri, position=None, callback=None):
+        # adds the tracks of a track, album or playlist link, at the end when no position is given
+        def insert_tracks(tracks):
+            if tracks is None:
                 if callback:
-                    callback(True)
+                    callback(False)
+                return
+
+            if position is None:
+                current_changed = self.play_queue_mgr.append_tracks(tracks)
+            else:
+                current_changed = self.play_queue_mgr.insert_tracks(position, tracks)
+
+            self.__play_queue_edited(current_changed)
+
+            if callback:
+                callback(True)
 
+        def prepare_insert(edit_ready):
+            # the link is resolved first, the tracks are inserted once the edits before are applied
+            def tracks_resolved(tracks):
+                edit_ready(lambda: insert_tracks(tracks))
+
+            tracks = self.prefetched_links.get(link_uri)
+            if tracks is not None:
+                tracks_resolved(tracks)
+            else:
+                self.__resolve_link(link_uri, tracks_resolved, PRIORITY_PLAYBACK)
+
+        self.__edit_play_queue(prepare_insert, lambda: insert_tracks(None))
+
+    def remove_from_playqueue(self, position, count=1, callback=None):
+        def remove_tracks():
+            self.__play_queue_edited(self.play_queue_mgr.remove_tracks(position, count))
+
+            if callback:
+                callback()
+
+        self.__edit_play_queue(lambda edit_ready: edit_ready(remove_tracks))
+
+    def move_in_playqueue(self, from_position, to_position, callback=None):
+        def move_track():
+            if self.play_queue_mgr.move_track(from_position, to_position):
+                self.__play_queue_edited(False)
+
+            if callback:
+                callback()
+
+        self.__edit_play_queue(lambda edit_ready: edit_ready(move_track))
+
+    def prefetch_links(self, link_uris):
+        def prefetch_links_command(session, command_done):
             try:
-                link = Link.from_string(link_uri)
+                # forget links that are no longer prefetched
+                for link_uri in set(self.prefetched_links) - set(link_uris):
+                    del self.prefetched_links[link_uri]
 
-                if link.type() == Link.LINK_PLAYLIST:
-                    self.get_playlist(link_uri, playlist_loaded)
-                elif link.type() == Link.LINK_ALBUM:
-                    self.browse_album(link_uri, album_loaded)
-                elif link.type() == Link.LINK_TRACK:
-                    self.load_track(link_uri, track_loaded)
+                for link_uri in link_uris:
+                    self.__prefetch_link(link_uri)
+            finally:
+                command_done()
+
+        self.event_thread.enqueue_cmd(prefetch_links_command, PRIORITY_BACKGROUND)
 
+    def prefetch_link(self, link_uri):
+        def prefetch_link_command(session, command_done):
+            try:
+                self.__prefetch_link(link_uri)
             finally:
                 command_done()
 
-        if link_uri == 'playqueue':
-            self.event_thread.enqueue_cmd(change_playqueue_track_command)
-        else:
-            self.event_thread.enqueue_cmd(play_link_command)
+        self.event_thread.enqueue_cmd(prefetch_link_command, PRIORITY_BACKGROUND)
 
+    def forget_prefetched_link(self, link_uri):
+        def forget_prefetched_link_command(session, command_done):
+            try:
+                self.prefetched_links.pop(link_uri, None)
+            finally:
+                command_done()
 
+        # queued behind the prefetches of the link
+        self.event_thread.enqueue_cmd(forget_prefetched_link_command, PRIORITY_BACKGROUND)
 
     def seek(self, offset, callback=None):
         def seek_command(session, command_done):
             try:
                 self.__pause_player()
+                self.audio_buffer.flush()
 
                 # set current offset
-                self.track_playback_time = offset
-                self.last_track_playback_time_notified = 0
+                self.audio_buffer.mark(offset)
 
                 self.__start_player()
                 session.seek(offset * 1000)
@@ -642,7 +1011,7 @@ class SpotifyAsyncSessionManager(object):
                 command_done()
 
 
-        self.event_thread.enqueue_cmd(seek_command)
+        self.event_thread.enqueue_cmd(seek_command, PRIORITY_CONTROL)
 
 
     def play(self, callback=None):
@@ -656,7 +1025,7 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(play_command)
+        self.event_thread.enqueue_cmd(play_command, PRIORITY_CONTROL)
 
     def pause(self, callback=None):
         def pause_command(sesson, command_done):
@@ -668,7 +1037,7 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(pause_command)
+        self.event_thread.enqueue_cmd(pause_command, PRIORITY_CONTROL)
 
     def next_track(self, callback=None):
         def next_track_command(sesson, command_done):
@@ -681,7 +1050,7 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(next_track_command)
+        self.event_thread.enqueue_cmd(next_track_command, PRIORITY_CONTROL)
 
     def previous_track(self, callback=None):
         def previous_track_command(sesson, command_done):
@@ -694,12 +1063,13 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(previous_track_command)
+        self.event_thread.enqueue_cmd(previous_track_command, PRIORITY_CONTROL)
 
     def set_shuffle(self, is_on, callback=None):
         def set_shuffle_command(sesson, command_done):
             try:
                 self.play_queue_mgr.set_shuffle(is_on)
+                self.__preload_next_track()
 
                 self.__fire_player_state_changed_event()
 
@@ -712,12 +1082,14 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(set_shuffle_command)
+        self.event_thread.enqueue_cmd(set_shuffle_command, PRIORITY_CONTROL)
 
     def set_repeat(self, is_on, callback=None):
         def set_repeat_command(sesson, command_done):
             try:
                 self.play_queue_mgr.set_repeat(is_on)
+                self.__preload_next_track()
+
                 self.__fire_player_state_changed_event()
 
                 if callback:
@@ -725,101 +1097,100 @@ class SpotifyAsyncSessionManager(object):
             finally:
                 command_done()
 
-        self.event_thread.enqueue_cmd(set_repeat_command)
+        self.event_thread.enqueue_cmd(set_repeat_command, PRIORITY_CONTROL)
 
     def search(self, query, callback, callback_userdata=None, track_offset=0, track_count=32, album_offset=0, album_count=32, artist_offset=0, artist_count=32, playlist_offset=0, playlist_count=32):
-        def search_command(session, command_done):
-            def search_callback(results, userdata):
-                try:
+        def start_search(done, priority):
+            def search_command(session, command_done):
+                def search_callback(results, userdata):
+                    try:
 
-                    callback(results, userdata)
-                finally:
-                    command_done()
-
-            session.search(query=query,
-                callback=search_callback,
-                userdata=callback_userdata,
-                track_offset = track_offset,
-                track_count = track_count,
-                album_offset = album_offset,
-                album_count = album_count,
-                artist_offset = artist_offset,
-                artist_count = artist_count,
-                playlist_offset = playlist_offset,
-                playlist_count = playlist_count)
-
-        self.event_thread.enqueue_cmd(search_command)
-
-    def browse_album(self, album_uri, callback):
-        def browse_album_command(sesson, command_done):
-            def browse_album_callback(browser, userdata):
-                try:
-                    callback(browser, userdata)
-                finally:
-                    command_done()
-
-            album_link = Link.from_string(album_uri)
-            album = album_link.as_album()
-
-            AlbumBrowser(album_link.as_album(), browse_album_callback, album)
-
-        self.event_thread.enqueue_cmd(browse_album_command)
-
-    def load_track(self, track_uri, callback):
-        def load_track_command(sesson, command_done):
-            def metadata_loaded_callback(track):
-                try:
-                    callback(track)
-                finally:
-                    command_done()
+                        done(results)
+                    finally:
+                        command_done()
 
-            track_link = Link.from_string(track_uri)
-            track = track_link.as_track()
+                session.search(query=query,
+                    callback=search_callback,
+                    track_offset = track_offset,
+                    track_count = track_count,
+                    album_offset = album_offset,
+                    album_count = album_count,
+                    artist_offset = artist_offset,
+                    artist_count = artist_count,
+                    playlist_offset = playlist_offset,
+                    playlist_count = playlist_count)
 
-            async_load = AsyncLoadedItem(track, lambda x: x.is_loaded() == 1, metadata_loaded_callback)
+            self.event_thread.enqueue_cmd(search_command, priority)
 
-            # first check if track is loaded, otherwise queue it for metadata watch
-            if not async_load.check_is_loaded():
-                self.metadata_waiters.append(async_load)
+        # userdata belongs to each caller, it is not part of the shared search
+        self.single_flight.do(
+            ('search', query, track_offset, track_count, album_offset, album_count, artist_offset, artist_count, playlist_offset, playlist_count),
+            PRIORITY_METADATA,
+            start_search,
+            lambda results: callback(results, callback_userdata))
 
-        self.event_thread.enqueue_cmd(load_track_command)
+    def browse_album(self, album_uri, callback, priority=PRIORITY_METADATA):
+        def start_browse_album(done, priority):
+            def browse_album_command(sesson, command_done):
+                def browse_album_callback(browser, userdata):
+                    try:
+                        done(browser, userdata)
+                    finally:
+                        command_done()
 
+                album_link = Link.from_string(album_uri)
+                album = album_link.as_album()
 
-    def load_image(self, image_id, callback, callback_userdata=None):
+                AlbumBrowser(album_link.as_album(), browse_album_callback, album)
 
+            self.event_thread.enqueue_cmd(browse_album_command, priority)
 
-        def load_image_command(session, command_done):
-            timeout = 1
-            start_time = time.time()
-            elapsed_time = 0
-            try:
-                image = session.image_create(image_id)
+        self.single_flight.do(('browse_album', album_uri), priority, start_browse_album, callback)
 
-                while not image.is_loaded() and elapsed_time < timeout:
-                    if elapsed_time != 0:
-                        logger.debug('Image still not loaded after %s sec', elapsed_time)
-                    elapsed_time = time.time() - start_time
-                    time.sleep(0.1)
-                    self.session.process_events()
+    def load_track(self, track_uri, callback, priority=PRIORITY_METADATA):
+        def start_load_track(done, priority):
+            def load_track_command(sesson, command_done):
+                def metadata_loaded_callback(track):
+                    try:
+                        done(track)
+                    finally:
+                        command_done()
 
-                if image.is_loaded():
-                    callback(image, callback_userdata)
-                else:
-                    print 'image error: ' + str(image.error())
-                    callback(None, callback_userdata)
+                def metadata_timeout_callback():
+                    logger.warning('Track %s not loaded after %s sec', track_uri, self.metadata_load_timeout)
+                    metadata_loaded_callback(None)
 
-            finally:
-                command_done()
-
-        self.event_thread.enqueue_cmd(load_image_command)
+                track_link = Link.from_string(track_uri)
+                track = track_link.as_track()
 
+                self.metadata_waiters.register(track_uri, track, lambda x: x.is_loaded() == 1, metadata_loaded_callback, self.metadata_load_timeout, metadata_timeout_callback)
 
+            self.event_thread.enqueue_cmd(load_track_command, priority)
 
+        self.single_flight.do(('load_track', track_uri), priority, start_load_track, callback)
 
 
+    def load_image(self, image_id, callback, callback_userdata=None):
+        def start_load_image(done, priority):
+            waiter_key = ('image', image_id)
 
+            def load_image_command(session, command_done):
+                def image_loaded(image):
+                    try:
+                        done(image)
+                    finally:
+                        command_done()
 
+                def image_timeout():
+                    logger.warning('Image %s not loaded after %s sec', binascii.hexlify(image_id), self.image_load_timeout)
+                    image_loaded(None)
 
+                image = session.image_create(image_id)
 
+                if self.metadata_waiters.register(waiter_key, image, lambda x: x.is_loaded(), image_loaded, self.image_load_timeout, image_timeout):
+                    # do not block the event thread, let libspotify tell when the image is loaded
+                    image.add_load_callback(lambda image, userdata: self.metadata_waiters.check(waiter_key), None)
 
+            self.event_thread.enqueue_cmd(load_image_command, priority)
 
+        self.single_flight.do(('load_image', image_id), PRIORITY_IMAGE, start_load_image, lambda image: callback(image, callback_userdata))
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class PlaybackMarker(object):
+
+    def __init__(self, offset):
+        # playback position in seconds at this point of the stream
+        self.offset = offset
+
+
+class PcmRingBuffer(object):
+
+    def __init__(self, capacity_frames):
+        self.capacity_frames = capacity_frames
+        self.chunks = collections.deque()
+        self.buffered_frames = 0
+        self.condition = threading.Condition()
+
+        # incremented on every flush, lets the output thread drop a chunk it is in the middle of writing
+        self.generation = 0
+
+        self.is_paused = False
+        self.is_running = False
+        self.is_closed = False
+
+        # statistics
+        self.overruns = 0
+        self.underruns = 0
+        self.frames_accepted = 0
+
+    def put(self, frames, frame_size, num_frames, sample_type, sample_rate, channels):
+        with self.condition:
+            free_frames = self.capacity_frames - self.buffered_frames
+
+            if free_frames <= 0:
+                # refuse, libspotify delivers the same frames again later
+                self.overruns += 1
+                return 0
+
+            # keep what fits, the rest is delivered again
+            num_frames = min(num_frames, free_frames)
+
+            # frames points into libspotify memory that is only valid during the callback
+            data = str(buffer(frames, 0, num_frames * frame_size))
+
+            self.chunks.append((data, frame_size, num_frames, sample_type, sample_rate, channels))
+            self.buffered_frames += num_frames
+            self.frames_accepted += num_frames
+
+            self.condition.notify()
+
+            return num_frames
+
+    def get(self):
+        with self.condition:
+            while not self.is_closed and (self.is_paused or not self.chunks):
+                if self.is_running and not self.is_paused:
+                    # ran dry while playing
+                    self.underruns += 1
+                    self.is_running = False
+
+                self.condition.wait()
+
+            if self.is_closed:
+                return None, self.generation
+
+            chunk = self.chunks.popleft()
+            if not isinstance(chunk, PlaybackMarker):
+                self.buffered_frames -= chunk[2]
+                self.is_running = True
+
+            return chunk, self.generation
+
+    def mark(self, offset):
+        # the playback clock is set to offset once the audio queued before the marker has been played
+        with self.condition:
+            self.chunks.append(PlaybackMarker(offset))
+            self.condition.notify()
+
+    def flush(self):
+        with self.condition:
+            # markers describe positions rather than audio and are kept
+            markers = [chunk for chunk in self.chunks if isinstance(chunk, PlaybackMarker)]
+            self.chunks.clear()
+            self.chunks.extend(markers)
+            self.buffered_frames = 0
+            self.generation += 1
+            self.is_running = False
+
+    def pause(self):
+        with self.condition:
+            self.is_paused = True
+            self.is_running = False
+
+    def resume(self):
+        with self.condition:
+            self.is_paused = False
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.is_closed = True
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                buffered_frames=self.buffered_frames,
+                capacity_frames=self.capacity_frames,
+                frames_accepted=self.frames_accepted,
+                overruns=self.overruns,
+                underruns=self.underruns)
+
+
+class MusicDeliveryMeter(object):
+
+    def __init__(self, report_interval=10):
+        # only used on libspotify's thread, reports are logged every report_interval seconds
+        self.report_interval = report_interval
+        self.__reset()
+
+    def __reset(self):
+        self.started = time.time()
+        self.calls = 0
+        self.frames_offered = 0
+        self.frames_accepted = 0
+        self.min_frames_accepted = None
+        self.max_frames_accepted = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, num_frames, accepted_frames, latency):
+        self.calls += 1
+        self.frames_offered += num_frames
+        self.frames_accepted += accepted_frames
+        self.min_frames_accepted = accepted_frames if self.min_frames_accepted is None else min(self.min_frames_accepted, accepted_frames)
+        self.max_frames_accepted = max(self.max_frames_accepted, accepted_frames)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        if time.time() - self.started >= self.report_interval:
+            logger.info('Music delivery: %s', ', '.join('{0}={1}'.format(k, v) for k, v in sorted(self.stats().iteritems())))
+            self.__reset()
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        calls = max(self.calls, 1)
+
+        return dict(
+            calls=self.calls,
+            frames_per_second=int(self.frames_accepted / elapsed),
+            frames_accepted_per_call=self.frames_accepted / calls,
+            min_frames_accepted=self.min_frames_accepted or 0,
+            max_frames_accepted=self.max_frames_accepted,
+            frames_refused=self.frames_offered - self.frames_accepted,
+            avg_latency_ms=round(self.total_latency / calls * 1000, 3),
+            max_latency_ms=round(self.max_latency * 1000, 3))
+
+
+class AudioOutputThread(threading.Thread):
+
+    retry_delay = 0.005
+
+    def __init__(self, ring_buffer, audio):
+        threading.Thread.__init__(self, name="audio_output")
+        self.daemon = True
+        self.ring_buffer = ring_buffer
+        self.audio = audio
+
+    def run(self):
+        logger.debug('Started audio output')
+
+        while True:
+            chunk, generation = self.ring_buffer.get()
+            if chunk is None:
+                break
+
+            if isinstance(chunk, PlaybackMarker):
+                self.audio.clock.reset(chunk.offset)
+                continue
+
+            frames, frame_size, num_frames, sample_type, sample_rate, channels = chunk
+
+            # write until the device has taken the whole chunk or the buffer is flushed
+            while num_frames > 0 and generation == self.ring_buffer.generation:
+                try:
+                    played_frames = self.audio.music_delivery(frames, frame_size, num_frames, sample_type, sample_rate, channels)
+                except Exception as e:
+                    logger.exception('Exception in audio output: %s', repr(e))
+                    break
+
+                if played_frames <= 0:
+                    time.sleep(self.retry_delay)
+                    continue
+
+                num_frames -= played_frames
+                frames = buffer(frames, played_frames * frame_size)
+
+                self.audio.clock.advance(played_frames, sample_rate)
+
+        logger.debug('Stopped audio output')
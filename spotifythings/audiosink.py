@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import wave
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PlaybackClock(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.offset = 0
+        self.frames = 0
+        self.sample_rate = 44100
+
+    def reset(self, offset=0):
+        with self.lock:
+            self.offset = offset
+            self.frames = 0
+
+    def advance(self, num_frames, sample_rate):
+        with self.lock:
+            if sample_rate != self.sample_rate:
+                # keep the position when the rate changes, count frames at the new rate from there
+                self.offset += float(self.frames) / self.sample_rate
+                self.frames = 0
+                self.sample_rate = sample_rate
+
+            self.frames += num_frames
+
+    def get_playback_time(self, latency_frames=0):
+        with self.lock:
+            # frames still queued in the device have not been heard yet
+            return self.offset + float(max(self.frames - latency_frames, 0)) / self.sample_rate
+
+
+class AudioSink(object):
+
+    def __init__(self):
+        # advanced by the output thread with the frames the sink has consumed
+        self.clock = PlaybackClock()
+
+    def music_delivery(self, frames, frame_size, num_frames, sample_type, sample_rate, channels):
+        # returns the number of frames consumed, sinks override this to output them, here they are discarded
+        return num_frames
+
+    def get_output_latency(self):
+        # number of consumed frames that are not yet audible
+        return 0
+
+    def get_playback_time(self):
+        return self.clock.get_playback_time(self.get_output_latency())
+
+    def close(self):
+        pass
+
+
+class AlsaSink(AudioSink):
+
+    # periods ALSA keeps in its buffer by default
+    buffered_periods = 4
+
+    def __init__(self, device='default', period_size=1024):
+        # optional dependency, only needed when playing to a sound card
+        import alsaaudio
+
+        super(AlsaSink, self).__init__()
+        self.alsaaudio = alsaaudio
+        self.device = device
+        self.period_size = period_size
+        self.pcm = None
+        self.format = None
+
+    def __open(self, sample_rate, channels):
+        pcm = self.alsaaudio.PCM(type=self.alsaaudio.PCM_PLAYBACK, mode=self.alsaaudio.PCM_NORMAL, card=self.device)
+        pcm.setchannels(channels)
+        pcm.setrate(sample_rate)
+        pcm.setformat(self.alsaaudio.PCM_FORMAT_S16_LE)
+        pcm.setperiodsize(self.period_size)
+
+        logger.info('Opened ALSA device %s, %s Hz, %s channels', self.device, sample_rate, channels)
+
+        return pcm
+
+    def music_delivery(self, frames, frame_size, num_frames, sample_type, sample_rate, channels):
+        if self.format != (sample_rate, channels):
+            self.close()
+            self.pcm = self.__open(sample_rate, channels)
+            self.format = (sample_rate, channels)
+
+        return self.pcm.write(frames)
+
+    def get_output_latency(self):
+        # a write returns once the frames are in the device buffer, assume it is full while playing
+        return self.period_size * self.buffered_periods if self.pcm else 0
+
+    def close(self):
+        if self.pcm:
+            self.pcm.close()
+            self.pcm = None
+            self.format = None
+
+
+class WavFileSink(AudioSink):
+
+    def __init__(self, filename):
+        super(WavFileSink, self).__init__()
+        self.filename = filename
+        self.wav = None
+        self.format = None
+        self.file_count = 0
+
+    def music_delivery(self, frames, frame_size, num_frames, sample_type, sample_rate, channels):
+        if self.format != (sample_rate, channels):
+            # a wav file has one format, start a new file when it changes
+            self.close()
+
+            self.wav = wave.open(self.__next_filename(), 'wb')
+            self.wav.setnchannels(channels)
+            self.wav.setsampwidth(frame_size / channels)
+            self.wav.setframerate(sample_rate)
+            self.format = (sample_rate, channels)
+
+        self.wav.writeframesraw(frames)
+
+        return num_frames
+
+    def __next_filename(self):
+        # the first file gets the configured name, the ones after it a numbered suffix
+        self.file_count += 1
+        if self.file_count == 1:
+            return self.filename
+
+        root, ext = os.path.splitext(self.filename)
+        return '{0}-{1}{2}'.format(root, self.file_count, ext)
+
+    def close(self):
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+            self.format = None
+
+
+class NullSink(AudioSink):
+
+    def __init__(self, realtime=False):
+        super(NullSink, self).__init__()
+        self.realtime = realtime
+
+    def music_delivery(self, frames, frame_size, num_frames, sample_type, sample_rate, channels):
+        # optionally consume frames at the pace of a sound card
+        if self.realtime:
+            time.sleep(float(num_frames) / float(sample_rate))
+
+        return num_frames
+
+
+def create_audio_sink(name, **options):
+    if name == 'alsa':
+        sink = AlsaSink(**options)
+    elif name == 'wav':
+        sink = WavFileSink(**options)
+    elif name == 'null':
+        sink = NullSink(**options)
+    else:
+        raise ValueError('Unknown audio sink {0}'.format(name))
+
+    return sink
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import itertools
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class EventDispatcher(object):
+
+    def __init__(self, ioloop, max_pending=256):
+        self.ioloop = ioloop
+        self.max_pending = max_pending
+
+        # key -> (handler, args, is_coalescable), oldest first
+        self.pending = OrderedDict()
+        self.pending_lock = threading.Lock()
+        self.is_scheduled = False
+
+        # keys for events that must not be coalesced
+        self.unique_keys = itertools.count()
+
+        # statistics
+        self.dispatched = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def dispatch(self, key, handler, *args):
+        # runs handler(*args) on the IOLoop, an event still pending under the same key is replaced
+        with self.pending_lock:
+            self.dispatched += 1
+
+            is_coalescable = key is not None
+            if not is_coalescable:
+                key = ('unique', next(self.unique_keys))
+            elif self.pending.pop(key, None):
+                self.coalesced += 1
+
+            self.pending[key] = (handler, args, is_coalescable)
+
+            # never block the caller, rather lose the oldest state event, events that must not be coalesced are kept
+            if len(self.pending) > self.max_pending:
+                self.__drop_oldest_coalescable()
+
+            if self.is_scheduled:
+                return
+
+            self.is_scheduled = True
+
+        # add_callback is the only IOLoop method safe to call from other threads
+        self.ioloop.add_callback(self.__run_pending)
+
+    def __drop_oldest_coalescable(self):
+        dropped_key = next((key for key, (handler, args, is_coalescable) in self.pending.iteritems() if is_coalescable), None)
+        if dropped_key is None:
+            return
+
+        del self.pending[dropped_key]
+        self.dropped += 1
+        logger.warning('Event queue full, dropped event %s', dropped_key)
+
+    def __run_pending(self):
+        with self.pending_lock:
+            events = self.pending.values()
+            self.pending = OrderedDict()
+            self.is_scheduled = False
+
+        for handler, args, is_coalescable in events:
+            try:
+                handler(*args)
+            except Exception as e:
+                logger.exception('Error in event handler: %s', repr(e))
+
+    def stats(self):
+        with self.pending_lock:
+            return dict(
+                pending=len(self.pending),
+                dispatched=self.dispatched,
+                coalesced=self.coalesced,
+                dropped=self.dropped)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import tempfile
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class ImageCache(object):
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.size = 0
+
+        # image id -> file size, least recently used first
+        self.entries = OrderedDict()
+        self.entries_lock = threading.Lock()
+
+    def __path(self, image_id):
+        return os.path.join(self.cache_dir, image_id)
+
+    def __evict(self):
+        evicted = []
+
+        while self.size > self.max_size and self.entries:
+            image_id, size = self.entries.popitem(last=False)
+            self.size -= size
+            evicted.append(image_id)
+
+        return evicted
+
+    def __remove_files(self, image_ids):
+        for image_id in image_ids:
+            try:
+                os.remove(self.__path(image_id))
+            except OSError as e:
+                logger.warning('Unable to remove cached image %s: %s', image_id, str(e))
+
+    def initialize(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+
+            # remove leftovers from interrupted writes
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        # restore lru order using the time each image was cached
+        with self.entries_lock:
+            for mtime, image_id, size in sorted(files):
+                self.entries[image_id] = size
+                self.size += size
+
+            evicted = self.__evict()
+
+        self.__remove_files(evicted)
+
+        logger.info('Image cache contains %s images, %s bytes', len(self.entries), self.size)
+
+    def get_path(self, image_id):
+        image_id = image_id.lower()
+
+        with self.entries_lock:
+            size = self.entries.pop(image_id, None)
+            if size is None:
+                return None
+
+            # mark as most recently used
+            self.entries[image_id] = size
+
+        return self.__path(image_id)
+
+    def put(self, image_id, data):
+        image_id = image_id.lower()
+
+        # write to a temp file and rename it so that readers never see a partially written image
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.rename(tmp_path, self.__path(image_id))
+        except (IOError, OSError) as e:
+            logger.warning('Unable to cache image %s: %s', image_id, str(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self.entries_lock:
+            previous_size = self.entries.pop(image_id, None)
+            if previous_size is not None:
+                self.size -= previous_size
+
+            self.entries[image_id] = len(data)
+            self.size += len(data)
+
+            evicted = self.__evict()
+
+        self.__remove_files(evicted)
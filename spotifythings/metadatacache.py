@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import time
+import json
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class MetadataCache(object):
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+
+        # uri -> (expires, size, data), least recently used first
+        self.entries = OrderedDict()
+        self.entries_lock = threading.Lock()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __evict(self):
+        while self.size > self.max_size and self.entries:
+            uri, (expires, size, data) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def get(self, uri):
+        with self.entries_lock:
+            entry = self.entries.pop(uri, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, size, data = entry
+
+            if expires <= time.time():
+                self.size -= size
+                self.misses += 1
+                return None
+
+            # mark as most recently used
+            self.entries[uri] = entry
+            self.hits += 1
+
+            return data
+
+    def put(self, uri, data, ttl=None):
+        # the serialized length is used as an estimate of the memory held by the entry
+        size = len(json.dumps(data))
+        expires = time.time() + (ttl or self.ttl)
+
+        with self.entries_lock:
+            previous = self.entries.pop(uri, None)
+            if previous:
+                self.size -= previous[1]
+
+            self.entries[uri] = (expires, size, data)
+            self.size += size
+
+            self.__evict()
+
+    def stats(self):
+        with self.entries_lock:
+            return dict(
+                entries=len(self.entries),
+                size=self.size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class AsyncLoadedItem(object):
+
+    __slots__ = ('obj', 'is_loaded', 'callbacks', 'timeout_callbacks', 'deadline')
+
+    def __init__(self, obj, is_loaded):
+        self.obj = obj
+        self.is_loaded = is_loaded
+        self.callbacks = []
+        self.timeout_callbacks = []
+        self.deadline = 0
+
+    def loaded(self):
+        for callback in self.callbacks:
+            try:
+                callback(self.obj)
+            except Exception as e:
+                logger.exception('Error in metadata loaded callback: %s', repr(e))
+
+    def timed_out(self):
+        for timeout_callback in self.timeout_callbacks:
+            try:
+                timeout_callback()
+            except Exception as e:
+                logger.exception('Error in metadata timeout callback: %s', repr(e))
+
+
+class MetadataWaiterRegistry(object):
+
+    def __init__(self):
+        # key -> waiter, every object is only checked once no matter how many are waiting for it
+        self.waiters = dict()
+
+        # heap of (deadline, key)
+        self.deadlines = []
+
+        self.is_metadata_updated = False
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def register(self, key, obj, is_loaded, callback, timeout, timeout_callback):
+        waiter = self.waiters.get(key)
+
+        if waiter is None:
+            # first check if object is loaded, otherwise start waiting for it
+            if is_loaded(obj):
+                callback(obj)
+                return False
+
+            waiter = AsyncLoadedItem(obj, is_loaded)
+            self.waiters[key] = waiter
+
+        waiter.callbacks.append(callback)
+        waiter.timeout_callbacks.append(timeout_callback)
+
+        deadline = time.time() + timeout
+        if deadline > waiter.deadline:
+            waiter.deadline = deadline
+            heapq.heappush(self.deadlines, (deadline, key))
+
+        return True
+
+    def check(self, key):
+        # check a single object, used when libspotify tells exactly what was loaded
+        waiter = self.waiters.get(key)
+
+        if waiter and waiter.is_loaded(waiter.obj):
+            del self.waiters[key]
+            waiter.loaded()
+
+    def metadata_updated(self):
+        # libspotify does not tell what was updated, checking is deferred until all pending events are processed
+        self.is_metadata_updated = True
+
+    def check_updated(self):
+        if not self.is_metadata_updated:
+            return
+
+        self.is_metadata_updated = False
+
+        loaded = [(key, waiter) for key, waiter in self.waiters.iteritems() if waiter.is_loaded(waiter.obj)]
+
+        for key, waiter in loaded:
+            del self.waiters[key]
+
+        for key, waiter in loaded:
+            logger.debug("Metadata load detected")
+            waiter.loaded()
+
+    def expire(self):
+        now = time.time()
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+
+            # skip waiters that are done or whose deadline has been extended
+            waiter = self.waiters.get(key)
+            if waiter is None or waiter.deadline != deadline:
+                continue
+
+            del self.waiters[key]
+            waiter.timed_out()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+class PlayQueueItem(object):
+
+    # one per track in the queue, kept small
+    __slots__ = ('track', 'original_index', 'link')
+
+    def __init__(self, track, original_index, link):
+        self.track = track
+        self.original_index = original_index
+        self.link = link
+
+
+class LinkPreview(object):
+
+    __slots__ = ('name', 'type', 'image_id', 'uri')
+
+    def __init__(self, name, type, image_id, uri):
+        self.name = name
+        self.type = type
+        self.image_id = image_id
+        self.uri = uri
+
+
+class RfidReader(object):
+    __slots__ = ('name', 'version', 'serial_no')
+
+    def __init__(self, name, version, serial_no):
+        self.name = name
+        self.version = version
+        self.serial_no = serial_no
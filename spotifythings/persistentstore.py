@@ -1,9 +1,11 @@
-import sqlite3
+import threading
 from sqlitestore import SqliteStore
 
 
 class TagModel(object):
 
+    __slots__ = ('id', 'rfidtag', 'spotifylink', 'linktype', 'imageid', 'name')
+
     def __init__(self, id, rfidtag, spotifylink, linktype, imageid, name):
         self.id = id
         self.rfidtag = rfidtag
@@ -41,55 +43,60 @@ class PersistentStore(SqliteStore):
         super(PersistentStore, self).__init__(database_file)
         self.__init_migrations()
 
-    def _create_connection(self):
-        return sqlite3.connect(self.database_file, isolation_level=None)
+        # in memory index of all tag mappings, written through to the database
+        self.__tags_by_rfid = dict()
+        self.__tags_by_link = dict()
+        self.__tags_lock = threading.Lock()
 
-    def _execute_transactional(self, action):
-        connection = self._create_connection()
+    def __index_tag(self, tag):
+        self.__unindex_tag(tag.rfidtag)
 
-        with connection:
-            try:
-                connection.row_factory = sqlite3.Row
-                return action(connection)
-            except:
-                connection.rollback()
-                raise
-            else:
-                connection.commit()
+        self.__tags_by_rfid[tag.rfidtag] = tag
+        self.__tags_by_link.setdefault(tag.spotifylink, set()).add(tag.rfidtag)
 
-    def _to_tagmodel(self, row):
-        return TagModel(row['Id'], row['RfidTag'], row['SpotifyLink'], row['LinkType'], row['ImageId'], row['Name'])
+    def __unindex_tag(self, rfid_tag):
+        tag = self.__tags_by_rfid.pop(rfid_tag, None)
+        if tag is None:
+            return
 
+        rfid_tags = self.__tags_by_link[tag.spotifylink]
+        rfid_tags.discard(rfid_tag)
+        if not rfid_tags:
+            del self.__tags_by_link[tag.spotifylink]
+
+    def initialize(self):
+        super(PersistentStore, self).initialize()
 
-    def find_all_tags(self):
         def select(connection):
             cursor = connection.cursor()
             cursor.execute("SELECT * FROM tagmapping")
             return [self._to_tagmodel(row) for row in cursor.fetchall()]
 
-        return self._execute_transactional(select)
+        tags = self._execute_transactional(select)
 
-    def find_by_tagid(self, rfid_tag):
-        def select(connection):
-            cursor = connection.cursor()
-            cursor.execute("SELECT * FROM tagmapping where RfidTag = ?", [rfid_tag])
+        with self.__tags_lock:
+            self.__tags_by_rfid.clear()
+            self.__tags_by_link.clear()
 
-            row = cursor.fetchone()
-            if row is None:
-                return None
+            for tag in tags:
+                self.__index_tag(tag)
+
+    def _to_tagmodel(self, row):
+        return TagModel(row['Id'], row['RfidTag'], row['SpotifyLink'], row['LinkType'], row['ImageId'], row['Name'])
 
-            return self._to_tagmodel(row)
 
-        return self._execute_transactional(select)
+    def find_all_tags(self):
+        with self.__tags_lock:
+            return sorted(self.__tags_by_rfid.itervalues(), key=lambda tag: tag.id)
 
+    def find_by_tagid(self, rfid_tag):
+        with self.__tags_lock:
+            return self.__tags_by_rfid.get(rfid_tag)
 
-    def find_tags_by_link(self, spotifylink):
-        def select(connection):
-            cursor = connection.cursor()
-            cursor.execute("SELECT RfidTag FROM tagmapping where SpotifyLink = ?", [spotifylink])
-            return [row['RfidTag'] for row in cursor.fetchall()]
 
-        return self._execute_transactional(select)
+    def find_tags_by_link(self, spotifylink):
+        with self.__tags_lock:
+            return list(self.__tags_by_link.get(spotifylink, []))
 
 
 
@@ -100,7 +107,11 @@ class PersistentStore(SqliteStore):
 
             return cursor.lastrowid
 
-        return self._execute_transactional(insert)
+        with self.__tags_lock:
+            tag_id = self._execute_transactional(insert)
+            self.__index_tag(TagModel(tag_id, rfid_tag, spotifylink, linktype, imageid, name))
+
+        return tag_id
 
     def update_tag(self, rfid_tag, spotifylink, linktype, imageid, name):
         def update(connection):
@@ -109,7 +120,15 @@ class PersistentStore(SqliteStore):
 
             return cursor.rowcount
 
-        return self._execute_transactional(update)
+        with self.__tags_lock:
+            rowsupdated = self._execute_transactional(update)
+
+            # tags are shared with readers, replace instead of modifying
+            tag = self.__tags_by_rfid.get(rfid_tag)
+            if rowsupdated and tag:
+                self.__index_tag(TagModel(tag.id, rfid_tag, spotifylink, linktype, imageid, name))
+
+        return rowsupdated
 
     def delete_tag(self, rfid_tag):
         def delete(connection):
@@ -118,7 +137,11 @@ class PersistentStore(SqliteStore):
 
             return cursor.rowcount
 
-        return self._execute_transactional(delete)
+        with self.__tags_lock:
+            rowsdeleted = self._execute_transactional(delete)
+            self.__unindex_tag(rfid_tag)
+
+        return rowsdeleted
 
     def set_config(self, key, value):
         def upsert(connection):
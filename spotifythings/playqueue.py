@@ -1,43 +1,222 @@
 # -*- coding: utf-8 -*-
-from random import shuffle
+import collections
+from array import array
+from random import randint
 from spotify import Link
+from models import PlayQueueItem
 
-class PlayQueueItem(object):
-
-    def __init__(self, track, original_index):
-        self.track = track
-        self.original_index = original_index
+class PlayeQueueManager(object):
 
-    def __cmp__(self, other):
-        if isinstance(other,PlayQueueItem):
-            return self.original_index - other.original_index
-        return 0
+    # number of changes kept for clients catching up
+    changelog_size = 32
 
-class PlayeQueueManager(object):
+    # tracks added to the queue per populate call
+    populate_chunk_size = 200
 
     def __init__(self):
         self.is_shuffle_on = False
         self.is_repeat_on = False
+
+        # position in play order
         self.current_track_index = -1
-        self.play_queue = []
+
+        # items in their original order, an item's original_index is its index here, removed items are None
+        self.items = []
+
+        # play order as original indexes, and the inverse: original index -> position
+        self.order = array('l')
+        self.positions = array('l')
+
+        # unshuffled order including edits, the play order is restored from it when shuffling is turned off
+        self.base_order = array('l')
+
+        # when shuffling, positions before this one are drawn, the rest is drawn as it is needed
+        self.shuffled_upto = 0
+
+        # link -> original indexes of the items playing that track
+        self.items_by_link = dict()
+
+        # tracks of the collection not yet added, incremented on every replace
+        self.pending_tracks = []
+        self.pending_offset = 0
+        self.generation = 0
+
+        # when shuffling, pending tracks drawn ahead of their turn are replaced by their item, the last one's index
+        self.drawn_ahead_upto = -1
+
+        # every change increments the version, clients apply the changes since the version they have
+        self.version = 0
+        self.changes = collections.deque(maxlen=self.changelog_size)
+
+    def __record_change(self, op, **data):
+        self.version += 1
+        data['op'] = op
+        self.changes.append((self.version, data))
+
+    def __record_current(self):
+        self.__record_change('current', position=self.current_track_index)
+
+    def __item_at(self, position):
+        self.__draw(position)
+        return self.items[self.order[position]]
+
+    def __swap(self, position, other_position):
+        index = self.order[position]
+        other_index = self.order[other_position]
+
+        self.order[position] = other_index
+        self.order[other_position] = index
+        self.positions[other_index] = position
+        self.positions[index] = other_position
+
+        self.__record_change('swap', positions=[position, other_position])
+
+    def __draw(self, position):
+        # Fisher-Yates, one step per position that is played or looked at
+        if not self.is_shuffle_on:
+            return
+
+        while self.shuffled_upto <= min(position, len(self.order) - 1):
+            # drawn over the pending tracks as well, a drawn pending track is added on its own
+            last_position = len(self.order) - 1 + len(self.pending_tracks) - self.pending_offset
+            drawn_position = randint(self.shuffled_upto, last_position)
+
+            if drawn_position >= len(self.order):
+                drawn_position = self.__add_drawn_ahead(self.pending_offset + drawn_position - len(self.order))
+                if drawn_position is None:
+                    # unavailable or already drawn, draw again
+                    continue
+
+            if drawn_position != self.shuffled_upto:
+                self.__swap(self.shuffled_upto, drawn_position)
+
+            self.shuffled_upto += 1
+
+    def __update_positions(self, start, end=None):
+        for position in xrange(start, len(self.order) if end is None else end):
+            self.positions[self.order[position]] = position
+
+    def __add_drawn_ahead(self, pending_index):
+        # adds the pending track at pending_index to the end of the play order, returns its position
+        track = self.pending_tracks[pending_index]
+        if track is None or isinstance(track, PlayQueueItem):
+            return None
+
+        if track.availability() != 1:
+            self.pending_tracks[pending_index] = None
+            return None
+
+        item = self.__add_item(track)
+        self.order.append(item.original_index)
+        self.positions.append(len(self.order) - 1)
+
+        # the item joins the unshuffled order when the tracks before it are populated
+        self.pending_tracks[pending_index] = item
+        self.drawn_ahead_upto = max(self.drawn_ahead_upto, pending_index)
+
+        self.__record_change('insert', position=len(self.order) - 1, items=[item])
+
+        return len(self.order) - 1
+
+    def __complete_base_order(self):
+        # populates the tracks before the ones drawn ahead of their turn
+        while self.pending_tracks and self.pending_offset <= self.drawn_ahead_upto:
+            self.__populate_chunk()
+
+        self.drawn_ahead_upto = -1
 
     def __apply_shuffling(self):
+        self.__complete_base_order()
+
         # locate current item by current track index
-        current_item = self.play_queue[self.current_track_index] if self.current_track_index != -1 else None
+        current_index = self.order[self.current_track_index] if self.current_track_index != -1 else None
 
-        if self.is_shuffle_on:
-            shuffle(self.play_queue)
-        else:
-            self.play_queue.sort()
+        # back to the unshuffled order, without sorting
+        self.order = array('l', self.base_order)
+        self.positions = array('l', [-1]) * len(self.items)
+        self.__update_positions(0)
+
+        self.shuffled_upto = 0
+
+        self.__record_change('order', order=self.base_order.tolist())
 
         # set current track index to same track as before shuffle/unshuffle
-        if current_item:
-            self.current_track_index = self.play_queue.index(current_item)
+        if current_index is not None:
+            self.current_track_index = current_index = self.positions[current_index]
+
+            # the current track is the first of a new shuffle
+            if self.is_shuffle_on:
+                if current_index != 0:
+                    self.__swap(0, current_index)
+
+                self.current_track_index = 0
+                self.shuffled_upto = 1
+
+    def __add_item(self, track):
+        # the link of each track is computed once
+        index = len(self.items)
+        link = str(Link.from_track(track))
+        item = PlayQueueItem(track, index, link)
+
+        self.items.append(item)
+        self.items_by_link.setdefault(link, []).append(index)
+
+        return item
+
+    def __populate(self, until_link=None, count=None):
+        # add pending tracks until the track with until_link or count tracks are added, returns the items added
+        added = []
+
+        while self.pending_offset < len(self.pending_tracks):
+            track = self.pending_tracks[self.pending_offset]
+            self.pending_offset += 1
+
+            # drawn ahead of its turn, only its place in the unshuffled order is left, unless it was removed since
+            if isinstance(track, PlayQueueItem):
+                if self.items[track.original_index] is track:
+                    self.base_order.append(track.original_index)
+                continue
+
+            if track is None or track.availability() != 1:
+                continue
+
+            item = self.__add_item(track)
+
+            # new items are appended to the play order, when shuffling they are part of the tracks not yet drawn
+            self.order.append(item.original_index)
+            self.positions.append(len(self.order) - 1)
+            self.base_order.append(item.original_index)
+
+            added.append(item)
+
+            if item.link == until_link or len(added) == count:
+                break
+
+        if self.pending_offset == len(self.pending_tracks):
+            self.pending_tracks = []
+            self.pending_offset = 0
+            self.drawn_ahead_upto = -1
 
+        return added
 
-    def __append_play_queue(self, track):
-        next_index = len(self.play_queue)
-        self.play_queue.append(PlayQueueItem(track, next_index))
+    def __populate_chunk(self):
+        position = len(self.order)
+        added = self.__populate(count=self.populate_chunk_size)
+
+        if added:
+            self.__record_change('insert', position=position, items=added)
+
+    def __ensure_populated(self, position):
+        # position -1 requires the whole queue
+        while (position < 0 or position >= len(self.order)) and self.pending_tracks:
+            self.__populate_chunk()
+
+    def __base_position(self, index, offset):
+        # a track drawn ahead of its turn is not in the unshuffled order yet, the populated part ends before it
+        try:
+            return self.base_order.index(index) + offset
+        except ValueError:
+            return len(self.base_order)
 
     def replace_queue(self, tracks, playing_track_link_uri):
 
@@ -45,66 +224,285 @@ class PlayeQueueManager(object):
         self.current_track_index = -1
 
         # clear current queue
-        del self.play_queue[:]
+        self.generation += 1
+        self.items = []
+        self.items_by_link = dict()
+        self.order = array('l')
+        self.positions = array('l')
+        self.base_order = array('l')
 
+        # only add tracks up to the one to play, the rest is added by populate
+        self.pending_tracks = list(tracks)
+        self.pending_offset = 0
+        self.drawn_ahead_upto = -1
+
+        if playing_track_link_uri:
+            self.__populate(until_link=playing_track_link_uri)
+        else:
+            self.__populate(count=1)
 
-        # add new tracks
-        for index, track in enumerate(filter(lambda track: track.availability() == 1,  tracks)):
-            self.__append_play_queue(track)
-            if str(Link.from_track(track)) == playing_track_link_uri:
-                self.current_track_index = index
+        playing_indexes = self.items_by_link.get(playing_track_link_uri)
+        if playing_indexes:
+            self.current_track_index = playing_indexes[0]
 
         # shuffle?
         self.__apply_shuffling()
 
 
-        if self.current_track_index == -1 and len(self.play_queue) > 0:
+        if self.current_track_index == -1 and len(self.order) > 0:
             self.current_track_index = 0
 
+        # clients fetch the whole queue
+        self.__record_change('reset')
+
     def set_shuffle(self, is_on):
         self.is_shuffle_on = is_on
         self.__apply_shuffling()
 
+        self.__record_current()
+
     def set_repeat(self, is_on):
         self.is_repeat_on = is_on
 
+    def populate(self):
+        # adds the next chunk of pending tracks, returns whether tracks are still pending
+        self.__populate_chunk()
+        return bool(self.pending_tracks)
+
+    def is_populated(self):
+        return not self.pending_tracks
+
     def move_next_track(self):
-        queue_length = len(self.play_queue)
+        self.__ensure_populated(self.current_track_index + 1)
+        queue_length = len(self.order)
 
         if (self.current_track_index + 1) < queue_length:
             self.current_track_index += 1
-            return True
         elif self.is_repeat_on and queue_length > 0:
             self.current_track_index = 0
-            return True
         else:
             return False
 
+        self.__record_current()
+        return True
+
     def move_previous_track(self):
-        queue_length = len(self.play_queue)
+        # wrapping around to the last track requires the whole queue
+        if self.current_track_index < 1 and self.is_repeat_on:
+            self.__ensure_populated(-1)
+
+        queue_length = len(self.order)
 
         if self.current_track_index >= 1:
             self.current_track_index -= 1
-            return True
         elif self.is_repeat_on and queue_length > 0:
             self.current_track_index = queue_length -1
-            return True
         else:
             return False
 
+        self.__record_current()
+        return True
+
+    def peek_next_track(self):
+        # the track move_next_track would move to
+        self.__ensure_populated(self.current_track_index + 1)
+        queue_length = len(self.order)
+
+        if (self.current_track_index + 1) < queue_length:
+            return self.__item_at(self.current_track_index + 1).track
+        elif self.is_repeat_on and queue_length > 0:
+            return self.__item_at(0).track
+        else:
+            return None
+
     def change_track(self, track_link):
-        for index, item in enumerate(self.play_queue):
-            if str(Link.from_track(item.track)) == track_link:
-                self.current_track_index = index
-                return True
+        indexes = self.items_by_link.get(track_link)
+        if not indexes and self.pending_tracks:
+            self.__ensure_populated(-1)
+            indexes = self.items_by_link.get(track_link)
+
+        if not indexes:
+            return False
+
+        position = self.positions[indexes[0]]
+
+        # a track not drawn yet becomes the next drawn one
+        if self.is_shuffle_on and position >= self.shuffled_upto:
+            if position != self.shuffled_upto:
+                self.__swap(self.shuffled_upto, position)
+                position = self.shuffled_upto
+
+            self.shuffled_upto += 1
+
+        self.current_track_index = position
+        self.__record_current()
+        return True
+
+    def append_tracks(self, tracks):
+        # added behind the tracks of the collection that are still pending
+        if self.pending_tracks:
+            self.pending_tracks.extend(tracks)
+            return False
+
+        return self.insert_tracks(len(self.order), tracks)
+
+    def insert_tracks(self, position, tracks):
+        # returns whether the current track changed
+        position = max(0, position)
+        if position > 0:
+            self.__ensure_populated(position - 1)
+
+        position = min(position, len(self.order))
+
+        # inserted tracks play exactly where they are put, also when shuffling
+        self.__draw(position - 1)
+
+        items = [self.__add_item(track) for track in tracks if track.availability() == 1]
+        if not items:
+            return False
+
+        inserted_indexes = array('l', [item.original_index for item in items])
+
+        # when shuffling, the unshuffled order gets them after the track they follow in play order
+        if not self.is_shuffle_on:
+            base_position = position
+        else:
+            base_position = self.__base_position(self.order[position - 1], 1) if position > 0 else \
+                self.__base_position(self.order[0], 0) if self.order else 0
+
+        self.base_order[base_position:base_position] = inserted_indexes
+
+        self.order[position:position] = inserted_indexes
+        self.positions.extend(array('l', [-1]) * len(items))
+        self.__update_positions(position)
+
+        if self.is_shuffle_on:
+            self.shuffled_upto += len(items)
+
+        self.__record_change('insert', position=position, items=items)
+
+        # an empty queue starts at the first inserted track
+        current_changed = self.current_track_index == -1
+        if current_changed:
+            self.current_track_index = position
+        elif position <= self.current_track_index:
+            self.current_track_index += len(items)
+        else:
+            return False
+
+        self.__record_current()
+        return current_changed
+
+    def remove_tracks(self, position, count=1):
+        # returns whether the current track was removed
+        if position < 0 or count < 1:
+            return False
+
+        self.__ensure_populated(position + count - 1)
+        end = min(position + count, len(self.order))
+        if position >= end:
+            return False
 
-        return False
+        removed_indexes = self.order[position:end]
+        del self.order[position:end]
+
+        for index in removed_indexes:
+            item = self.items[index]
+
+            indexes = self.items_by_link[item.link]
+            indexes.remove(index)
+            if not indexes:
+                del self.items_by_link[item.link]
+
+            self.items[index] = None
+            self.positions[index] = -1
+
+        self.__update_positions(position)
+
+        if self.is_shuffle_on:
+            self.shuffled_upto -= max(0, min(end, self.shuffled_upto) - position)
+            self.base_order = array('l', (index for index in self.base_order if self.items[index] is not None))
+        else:
+            del self.base_order[position:end]
+
+        self.__record_change('remove', position=position, count=end - position)
+
+        # the track after the removed ones becomes current
+        current_removed = position <= self.current_track_index < end
+        if current_removed:
+            self.__ensure_populated(position)
+
+            # at the end of the queue, wrap around like move_next_track or stop
+            if position < len(self.order):
+                self.current_track_index = position
+            elif self.is_repeat_on and len(self.order) > 0:
+                self.current_track_index = 0
+            else:
+                self.current_track_index = -1
+        elif self.current_track_index >= end:
+            self.current_track_index -= end - position
+        else:
+            return False
+
+        self.__record_current()
+        return current_removed
+
+    def move_track(self, from_position, to_position):
+        if from_position < 0:
+            return False
+
+        to_position = max(0, to_position)
+        self.__ensure_populated(max(from_position, to_position))
+
+        last_position = len(self.order) - 1
+        if not (0 <= from_position <= last_position):
+            return False
+
+        to_position = max(0, min(to_position, last_position))
+        if from_position == to_position:
+            return False
+
+        self.__draw(max(from_position, to_position))
+
+        index = self.order.pop(from_position)
+        self.order.insert(to_position, index)
+        self.__update_positions(min(from_position, to_position), max(from_position, to_position) + 1)
+
+        # a move while shuffling only changes the shuffled order
+        if not self.is_shuffle_on:
+            self.base_order.pop(from_position)
+            self.base_order.insert(to_position, index)
+
+        self.__record_change('move', from_position=from_position, to_position=to_position)
+
+        # the current track keeps playing at its new position
+        if self.current_track_index == from_position:
+            self.current_track_index = to_position
+        elif from_position < self.current_track_index <= to_position:
+            self.current_track_index -= 1
+        elif to_position <= self.current_track_index < from_position:
+            self.current_track_index += 1
+        else:
+            return True
+
+        self.__record_current()
+        return True
 
     def get_tracks(self):
-        return [item.track for item in self.play_queue]
+        return [self.items[index].track for index in self.order]
 
-    def get_current_track(self):
-        return self.play_queue[self.current_track_index].track if self.current_track_index != -1 else None
+    def get_items(self):
+        return [self.items[index] for index in self.order]
 
+    def get_changes(self, since_version):
+        # changes after since_version, None if they are no longer known
+        if since_version == self.version:
+            return []
 
+        if not self.changes or since_version > self.version or since_version < self.changes[0][0] - 1:
+            return None
 
+        return [change for version, change in self.changes if version > since_version]
+
+    def get_current_track(self):
+        return self.__item_at(self.current_track_index).track if self.current_track_index != -1 else None
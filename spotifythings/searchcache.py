@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+import tornado.ioloop
+
+logger = logging.getLogger(__name__)
+
+class SearchWindow(object):
+
+    def __init__(self, track_offset, track_count, album_offset, album_count):
+        self.track_offset = track_offset
+        self.track_count = track_count
+        self.album_offset = album_offset
+        self.album_count = album_count
+
+    def covers(self, other):
+        # an empty range is covered by any window
+        return (other.track_count == 0 or (self.track_offset <= other.track_offset and other.track_offset + other.track_count <= self.track_offset + self.track_count)) and \
+            (other.album_count == 0 or (self.album_offset <= other.album_offset and other.album_offset + other.album_count <= self.album_offset + self.album_count))
+
+    def slice(self, result, other):
+        # cut the requested page out of a result fetched for this window
+        track_start = other.track_offset - self.track_offset
+        album_start = other.album_offset - self.album_offset
+
+        page = dict(result)
+        page['tracks'] = result['tracks'][track_start:track_start + other.track_count]
+        page['albums'] = result['albums'][album_start:album_start + other.album_count]
+
+        return page
+
+
+class PendingSearch(object):
+
+    def __init__(self, window):
+        self.window = window
+        self.started = time.time()
+        self.waiters = []
+        self.is_finished = False
+
+
+class SearchCache(object):
+
+    def __init__(self, spotify_session, serializer, max_queries, ttl, max_windows_per_query=4, pending_timeout=30):
+        self.spotify_session = spotify_session
+        self.serializer = serializer
+        self.max_queries = max_queries
+        self.ttl = ttl
+        self.max_windows_per_query = max_windows_per_query
+        self.pending_timeout = pending_timeout
+
+        # query -> list of (expires, window, result), least recently used query first
+        self.entries = OrderedDict()
+
+        # query -> list of searches that are in progress
+        self.pending = dict()
+
+        self.lock = threading.Lock()
+
+        # statistics
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.timeouts = 0
+
+    def __find_cached(self, query, window):
+        windows = self.entries.pop(query, None)
+        if not windows:
+            return None
+
+        now = time.time()
+        windows = [entry for entry in windows if entry[0] > now]
+        if not windows:
+            return None
+
+        # mark as most recently used
+        self.entries[query] = windows
+
+        for expires, cached_window, result in windows:
+            if cached_window.covers(window):
+                return cached_window.slice(result, window)
+
+        return None
+
+    def __store(self, query, window, result):
+        windows = self.entries.pop(query, [])
+        windows.insert(0, (time.time() + self.ttl, window, result))
+        del windows[self.max_windows_per_query:]
+
+        self.entries[query] = windows
+
+        while len(self.entries) > self.max_queries:
+            self.entries.popitem(last=False)
+
+    def __finish(self, query, pending_search, result):
+        # a search is finished by its result or its timeout, whichever comes first
+        with self.lock:
+            if pending_search.is_finished:
+                return
+
+            pending_search.is_finished = True
+
+            searches = self.pending.get(query, [])
+            searches.remove(pending_search)
+            if not searches:
+                del self.pending[query]
+
+            if result is not None:
+                self.__store(query, pending_search.window, result)
+
+        for waiter_window, waiter_callback in pending_search.waiters:
+            try:
+                waiter_callback(pending_search.window.slice(result, waiter_window) if result is not None else None)
+            except Exception as e:
+                logger.exception('Error in search callback: %s', repr(e))
+
+    def search(self, query, callback, track_offset=0, track_count=10, album_offset=0, album_count=10):
+        window = SearchWindow(track_offset, track_count, album_offset, album_count)
+
+        with self.lock:
+            # answer from a cached window covering the requested page
+            page = self.__find_cached(query, window)
+            if page is not None:
+                self.hits += 1
+            else:
+                # attach to a search in progress covering the requested page, unless it seems to never finish
+                started_after = time.time() - self.pending_timeout
+                pending_search = next((p for p in self.pending.get(query, []) if p.started > started_after and p.window.covers(window)), None)
+                if pending_search:
+                    self.coalesced += 1
+                    pending_search.waiters.append((window, callback))
+                    return
+
+                self.misses += 1
+
+                pending_search = PendingSearch(window)
+                pending_search.waiters.append((window, callback))
+                self.pending.setdefault(query, []).append(pending_search)
+
+        if page is not None:
+            callback(page)
+            return
+
+        def search_finished(results, userdata):
+            try:
+                result = self.serializer(results)
+            except:
+                logger.exception('Unable to serialize search result for %s', query)
+                result = None
+
+            self.__finish(query, pending_search, result)
+
+        def search_timed_out():
+            if not pending_search.is_finished:
+                logger.warning('Search for %s not finished after %s sec', query, self.pending_timeout)
+                self.timeouts += 1
+                self.__finish(query, pending_search, None)
+
+        # the waiting requests are answered with an error when the result never arrives
+        tornado.ioloop.IOLoop.instance().add_timeout(pending_search.started + self.pending_timeout, search_timed_out)
+
+        self.spotify_session.search(
+            query = query,
+            callback = search_finished,
+            track_offset = track_offset,
+            track_count = track_count,
+            album_offset = album_offset,
+            album_count = album_count,
+            playlist_count = 0,
+            artist_count = 0)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                queries=len(self.entries),
+                hits=self.hits,
+                coalesced=self.coalesced,
+                misses=self.misses,
+                timeouts=self.timeouts)
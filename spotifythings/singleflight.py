@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Flight(object):
+
+    def __init__(self, callback, priority):
+        self.started = time.time()
+        self.callbacks = [callback]
+        self.priority = priority
+        self.is_done = False
+
+
+class SingleFlight(object):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.flights = dict()
+        self.flights_lock = threading.Lock()
+
+        # statistics
+        self.calls = 0
+        self.collapsed = 0
+        self.escalated = 0
+
+    def do(self, key, priority, start, callback):
+        # start(done, priority) begins the request, done(*args) hands the result to every caller of the same key
+        # a lower priority value is more urgent
+        with self.flights_lock:
+            self.calls += 1
+
+            flight = self.flights.get(key)
+            is_new = False
+
+            # attach to the request in flight, unless it seems to never finish
+            if flight and flight.started > time.time() - self.timeout:
+                flight.callbacks.append(callback)
+                self.collapsed += 1
+
+                logger.debug('Request %s attached to one in flight, %s of %s calls collapsed', key[0], self.collapsed, self.calls)
+
+                if priority >= flight.priority:
+                    return
+
+                # a more urgent caller does not wait behind the request in flight, it is started again at its priority
+                flight.priority = priority
+                self.escalated += 1
+            else:
+                flight = Flight(callback, priority)
+                self.flights[key] = flight
+                is_new = True
+
+        def done(*args):
+            # the first of the started requests to finish answers every caller
+            with self.flights_lock:
+                if flight.is_done:
+                    return
+
+                flight.is_done = True
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+            for flight_callback in flight.callbacks:
+                try:
+                    flight_callback(*args)
+                except Exception as e:
+                    logger.exception('Error in callback of %s: %s', key, repr(e))
+
+        try:
+            start(done, priority)
+        except:
+            if is_new:
+                with self.flights_lock:
+                    if self.flights.get(key) is flight:
+                        del self.flights[key]
+            raise
+
+    def stats(self):
+        with self.flights_lock:
+            return dict(
+                calls=self.calls,
+                collapsed=self.collapsed,
+                escalated=self.escalated,
+                in_flight=len(self.flights))
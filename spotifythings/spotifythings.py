@@ -11,7 +11,20 @@ from signal import SIGTERM
 from appcontainer import AppContainer
 
 def create_appcontainer():
-    return AppContainer(dict(dbfilename=os.path.join(os.path.dirname(__file__), 'spotifythings.db'), listen_port=8888))
+    return AppContainer(dict(
+        dbfilename=os.path.join(os.path.dirname(__file__), 'spotifythings.db'),
+        imagecache_dir=os.path.join(os.path.dirname(__file__), 'imagecache'),
+        imagecache_size=64 * 1024 * 1024,
+        metadatacache_size=4 * 1024 * 1024,
+        metadatacache_ttl=60 * 60,
+        searchcache_queries=128,
+        searchcache_ttl=5 * 60,
+        prefetch_interval=15 * 60,
+        playback_progress_interval=1,
+        audio_sink='alsa',
+        audio_sink_options=dict(),
+        measure_music_delivery=False,
+        listen_port=8888))
 
 def is_console_app():
     return len(sys.argv) == 2 and sys.argv[1] == 'console'
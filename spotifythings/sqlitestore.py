@@ -2,16 +2,39 @@
 import sqlite3
 import datetime
 import functools
+import threading
+import weakref
 import logging
 
 logger = logging.getLogger(__name__)
 
+class ThreadConnection(object):
+
+    # only referenced by the local storage of its thread, it is collected when the thread exits
+    __slots__ = ('connection', '__weakref__')
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
 class SqliteStore(object):
 
+    cached_statements = 100
+
     def __init__(self, database_file):
         self.database_file = database_file
         self.__migrations = []
 
+        # one connection per thread, closed when the thread exits, weak reference to the thread's holder -> connection
+        self.__local = threading.local()
+        self.__connections = dict()
+        self.__connections_lock = threading.Lock()
+
+        # statistics
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connections_closed = 0
+
 
     def __init_versioning(self):
         def create_table(connection):
@@ -35,14 +58,48 @@ class SqliteStore(object):
 
 
     def _create_connection(self):
-        return sqlite3.connect(self.database_file, isolation_level=None)
+        # connections are only used by the thread that created them, but closed on whichever thread closes the store or collects an exited thread
+        connection = sqlite3.connect(self.database_file, isolation_level=None, check_same_thread=False, cached_statements=self.cached_statements)
+        connection.row_factory = sqlite3.Row
+
+        # readers do not block the writer and commits do not sync the sd card on every write
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        return connection
+
+    def _get_connection(self):
+        holder = getattr(self.__local, 'holder', None)
+
+        with self.__connections_lock:
+            if holder is None:
+                holder = ThreadConnection(self._create_connection())
+                self.__local.holder = holder
+                self.__connections[weakref.ref(holder, self.__thread_exited)] = holder.connection
+                self.connections_created += 1
+
+                logger.debug('Created connection to %s for thread %s', self.database_file, threading.current_thread().name)
+            else:
+                self.connections_reused += 1
+
+        return holder.connection
+
+    def __thread_exited(self, holder_ref):
+        # called by whichever thread collects the holder, the connection is no longer used by its thread
+        with self.__connections_lock:
+            connection = self.__connections.pop(holder_ref, None)
+            if connection is None:
+                return
+
+            self.connections_closed += 1
+
+        connection.close()
 
     def _execute_transactional(self, action):
-        connection = self.__create_connection()
+        connection = self._get_connection()
 
         with connection:
             try:
-                connection.row_factory = sqlite3.Row
                 return action(connection)
             except:
                 connection.rollback()
@@ -50,6 +107,23 @@ class SqliteStore(object):
             else:
                 connection.commit()
 
+    def close(self):
+        with self.__connections_lock:
+            for connection in self.__connections.itervalues():
+                connection.close()
+
+            self.__connections.clear()
+
+        self.__local = threading.local()
+
+    def connection_stats(self):
+        with self.__connections_lock:
+            return dict(
+                open_connections=len(self.__connections),
+                connections_created=self.connections_created,
+                connections_reused=self.connections_reused,
+                connections_closed=self.connections_closed)
+
     def add_migration(self, migration):
         self.__migrations.append(migration)
 
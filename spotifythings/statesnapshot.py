@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from collections import OrderedDict
+
+class StateSnapshot(object):
+
+    def __init__(self):
+        # message type -> encoded latest message of that type
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+        self.snapshot_frame = None
+
+    def update(self, msg):
+        frame = json.dumps(msg)
+
+        with self.lock:
+            self.frames[msg['type']] = frame
+            self.snapshot_frame = None
+
+    def get_frame(self):
+        # all state in one frame, joined from the encoded messages only after a change
+        with self.lock:
+            if self.snapshot_frame is None:
+                self.snapshot_frame = '{"type": "snapshot", "data": [' + ', '.join(self.frames.itervalues()) + ']}'
+
+            return self.snapshot_frame
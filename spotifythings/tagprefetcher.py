@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import tornado.ioloop
+
+logger = logging.getLogger(__name__)
+
+class TagPrefetcher(object):
+
+    def __init__(self, store, spotify_session, refresh_interval):
+        self.store = store
+        self.spotify_session = spotify_session
+        self.refresh_interval = refresh_interval
+        self.periodic_callback = None
+
+    def refresh(self):
+        # links can only be resolved when logged in
+        if not self.spotify_session.is_logged_in:
+            return
+
+        link_uris = set(tag.spotifylink for tag in self.store.find_all_tags())
+
+        logger.debug('Prefetching %s tag mapped links', len(link_uris))
+        self.spotify_session.prefetch_links(link_uris)
+
+    def start(self):
+        self.periodic_callback = tornado.ioloop.PeriodicCallback(self.refresh, self.refresh_interval * 1000)
+        self.periodic_callback.start()
+
+    def stop(self):
+        if self.periodic_callback:
+            self.periodic_callback.stop()
+            self.periodic_callback = None
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Measures the memory per object of the slotted model classes against the same classes without slots.
+#
+#   python tools/slots_benchmark.py [count]
+import os
+import sys
+import gc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from models import PlayQueueItem, LinkPreview, RfidReader
+from persistentstore import TagModel
+from metadatawaiters import AsyncLoadedItem
+
+def without_slots(cls):
+    # same constructor, attributes stored in a per-instance __dict__
+    return type(cls.__name__, (object,), dict(__init__=cls.__init__.im_func))
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+
+    return size
+
+def measure(cls, args, count):
+    # bytes of one object, and of count objects kept in a list
+    objects = [cls(*args) for i in xrange(count)]
+    total = sum(object_size(obj) for obj in objects) + sys.getsizeof(objects)
+
+    return object_size(objects[0]), total
+
+def main(count):
+    benchmarks = [
+        (PlayQueueItem, (None, 1000, 'spotify:track:6rqhFgbbKwnb9MLmUQDhG6')),
+        (TagModel, (1, '0102030405', 'spotify:album:2hmgRzaxfnNfSxNbJiQaFu', 'album', '0123456789abcdef0123', 'Album')),
+        (LinkPreview, ('Album', 'album', '0123456789abcdef0123', 'spotify:album:2hmgRzaxfnNfSxNbJiQaFu')),
+        (AsyncLoadedItem, (None, None)),
+        (RfidReader, ('Phidget RFID 2-output', 104, 12345))]
+
+    print 'Python {0}, {1} objects per class'.format(sys.version.split()[0], count)
+    print '{0:<16} {1:>12} {2:>12} {3:>14} {4:>14}'.format('class', 'bytes/dict', 'bytes/slots', 'total/dict', 'total/slots')
+
+    for cls, args in benchmarks:
+        gc.collect()
+        dict_size, dict_total = measure(without_slots(cls), args, count)
+        slots_size, slots_total = measure(cls, args, count)
+
+        print '{0:<16} {1:>12} {2:>12} {3:>14} {4:>14}'.format(cls.__name__, dict_size, slots_size, dict_total, slots_total)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
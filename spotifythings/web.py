@@ -12,6 +12,8 @@ from tornado.httpclient import AsyncHTTPClient
 # spotify
 from spotify import Link
 
+from wsmessage import playqueue_item_to_dict, playqueue_changes_to_list
+
 logger = logging.getLogger(__name__)
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -19,10 +21,31 @@ class BaseHandler(tornado.web.RequestHandler):
 
 
 
+def search_result_to_dict(results):
+    return dict(
+        albums = [{
+            'album_name': x.name(),
+            'artist_name':x.artist().name(),
+            'image_id': binascii.hexlify(x.cover()),
+            'link': str(Link.from_album(x))} for x in results.albums()],
+        total_albums = results.total_albums(),
+        tracks = [{
+            'track_name': track.name(),
+            'artists': [artist.name() for artist in track.artists()],
+            'duration': track.duration(),
+            'popularity': track.popularity(),
+            'album': track.album().name(),
+            'is_available': track.availability() == 1,
+            'link': str(Link.from_track(track))
+            } for track in results.tracks()],
+        total_tracks = results.total_tracks(),
+        query = results.query())
+
+
 class SearchJsonHandler(BaseHandler):
 
-    def initialize(self, spotify_session):
-        self.spotify_session = spotify_session
+    def initialize(self, search_cache):
+        self.search_cache = search_cache
 
 
     @tornado.web.asynchronous
@@ -33,56 +56,52 @@ class SearchJsonHandler(BaseHandler):
         track_count = int(self.get_argument("tc", 10));
         album_count = int(self.get_argument("ac", 10));
 
-        self.spotify_session.search(
+        self.search_cache.search(
             query = query,
             callback = self.search_finished,
-            callback_userdata = query,
             track_count = track_count,
             track_offset = track_offset,
             album_count = album_count,
-            album_offset = album_offset,
-            playlist_count = 0,
-            artist_count = 0)
-
-    def search_finished(self, results, userdata):
-
-        albums = [{
-            'album_name': x.name(),
-            'artist_name':x.artist().name(),
-            'image_id': binascii.hexlify(x.cover()),
-            'link': str(Link.from_album(x))} for x in results.albums()]
-
-        tracks = [{
-            'track_name': track.name(),
-            'artists': [artist.name() for artist in track.artists()],
-            'duration': track.duration(),
-            'popularity': track.popularity(),
-            'album': track.album().name(),
-            'is_available': track.availability() == 1,
-            'link': str(Link.from_track(track))
-            } for track in results.tracks() if track.availability() == 1]
+            album_offset = album_offset)
 
+    def search_finished(self, result):
+        if result is None:
+            self.set_status(500)
+            self.finish()
+            return
 
-        self.write(dict(
-            albums = albums,
-            total_albums = results.total_albums(),
-            tracks = tracks,
-            total_tracks = results.total_tracks(),
-            query = results.query()))
+        # offsets are counted on all tracks, unavailable tracks are left out of the page
+        page = dict(result)
+        page['tracks'] = [track for track in result['tracks'] if track['is_available']]
 
+        self.write(page)
         self.finish()
 
 class AlbumInfoJsonHandler(BaseHandler):
 
-    def initialize(self, spotify_session):
+    def initialize(self, spotify_session, metadata_cache):
         self.spotify_session = spotify_session
+        self.metadata_cache = metadata_cache
 
 
     @tornado.web.asynchronous
     def get(self, album_uri):
+        album_info = self.metadata_cache.get(album_uri)
+        if album_info:
+            self.write(album_info)
+            self.finish()
+            return
+
+        self.album_uri = album_uri
         self.spotify_session.browse_album(album_uri, self.album_loaded)
 
     def album_loaded(self, browser, album):
+        # a failed browse is answered without caching it, the next request tries again
+        if not browser or not browser.is_loaded() or not album.is_loaded():
+            self.set_status(404)
+            self.finish()
+            return
+
         discs = dict()
 
         for track in browser:
@@ -94,7 +113,7 @@ class AlbumInfoJsonHandler(BaseHandler):
 
         arist = album.artist().name()
 
-        self.write(dict(
+        album_info = dict(
             album_name = album.name(),
             artist = arist,
             type = album.type(),
@@ -108,9 +127,11 @@ class AlbumInfoJsonHandler(BaseHandler):
                     'duration': x.duration(),
                     'link': str(Link.from_track(x)),
                     'is_available': track.availability() == 1,
-                    'artists': [artist.name() for artist in x.artists()] } for x in tracks]} for discno, tracks in discs.iteritems()]))
+                    'artists': [artist.name() for artist in x.artists()] } for x in tracks]} for discno, tracks in discs.iteritems()])
 
+        self.metadata_cache.put(self.album_uri, album_info)
 
+        self.write(album_info)
         self.finish()
 
 
@@ -137,37 +158,99 @@ class PlayQueueHandler(BaseHandler):
 
     @tornado.web.asynchronous
     def get(self):
-        def playqueue_callback(playqueue):
-            self.write(dict(result=[{
-                    'track_name': track.name(),
-                    'duration': track.duration(),
-                    'link': str(Link.from_track(track)),
-                    'is_available': track.availability() == 1,
-                    'artists': [artist.name() for artist in track.artists()] } for track in playqueue]))
+        since = self.get_argument('since', None)
+
+        def playqueue_callback(playqueue, version, current):
+            self.write(dict(
+                version=version,
+                current=current,
+                result=[playqueue_item_to_dict(item) for item in playqueue]))
             self.finish()
 
-        self.spotify_session.get_playqueue(playqueue_callback)
+        def changes_callback(changes, version):
+            # changes no longer known, send the whole queue
+            if changes is None:
+                self.spotify_session.get_playqueue(playqueue_callback)
+                return
 
-class TrackInfoJsonHandler(BaseHandler):
+            self.write(dict(version=version, changes=playqueue_changes_to_list(changes)))
+            self.finish()
+
+        if since is not None:
+            self.spotify_session.get_playqueue_changes(int(since), changes_callback)
+        else:
+            self.spotify_session.get_playqueue(playqueue_callback)
+
+class PlayQueueTracksHandler(BaseHandler):
 
     def initialize(self, spotify_session):
         self.spotify_session = spotify_session
 
+    @tornado.web.asynchronous
+    def post(self):
+        def inserted(success):
+            if not success:
+                self.set_status(404)
+            self.finish()
+
+        data = json.loads(self.request.body)
+        self.spotify_session.insert_into_playqueue(data['link'], data.get('position'), inserted)
+
+
+class PlayQueueTrackHandler(BaseHandler):
+
+    def initialize(self, spotify_session):
+        self.spotify_session = spotify_session
+
+    @tornado.web.asynchronous
+    def delete(self, position):
+        count = int(self.get_argument('count', 1))
+        self.spotify_session.remove_from_playqueue(int(position), count, self.finish)
+
+    @tornado.web.asynchronous
+    def put(self, position):
+        data = json.loads(self.request.body)
+        self.spotify_session.move_in_playqueue(int(position), int(data['position']), self.finish)
+
+class TrackInfoJsonHandler(BaseHandler):
+
+    def initialize(self, spotify_session, metadata_cache):
+        self.spotify_session = spotify_session
+        self.metadata_cache = metadata_cache
+
     @tornado.web.asynchronous
     def get(self, track_uri):
         def track_loaded(track):
-            self.write(dict(
+            if not track:
+                self.set_status(404)
+                self.finish()
+                return
+
+            track_info = dict(
                 name=track.name(),
-                link=str(Link.from_track(track))))
+                link=str(Link.from_track(track)))
 
+            self.metadata_cache.put(track_uri, track_info)
+
+            self.write(track_info)
             self.finish()
 
+        track_info = self.metadata_cache.get(track_uri)
+        if track_info:
+            self.write(track_info)
+            self.finish()
+            return
+
         self.spotify_session.load_track(track_uri, track_loaded)
 
 class PlaylistInfoJsonHandler(BaseHandler):
 
-    def initialize(self, spotify_session):
+    # playlists are editable, keep them for a shorter time than albums and tracks
+    cache_ttl = 60
+
+    def initialize(self, spotify_session, metadata_cache):
         self.spotify_session = spotify_session
+        self.metadata_cache = metadata_cache
 
     @tornado.web.asynchronous
     def get(self, link):
@@ -175,7 +258,7 @@ class PlaylistInfoJsonHandler(BaseHandler):
             if not playlist:
                 self.set_status(404)
             else:
-                self.write(dict(
+                playlist_info = dict(
                     name=playlist.name(),
                     link=str(Link.from_playlist(playlist)),
                     tracks = [{
@@ -183,9 +266,19 @@ class PlaylistInfoJsonHandler(BaseHandler):
                         'duration': track.duration(),
                         'link': str(Link.from_track(track)),
                         'is_available': track.availability() == 1,
-                        'artists': [artist.name() for artist in track.artists()] } for track in playlist]))
+                        'artists': [artist.name() for artist in track.artists()] } for track in playlist])
 
+                self.metadata_cache.put(link, playlist_info, self.cache_ttl)
+
+                self.write(playlist_info)
+
+            self.finish()
+
+        playlist_info = self.metadata_cache.get(link)
+        if playlist_info:
+            self.write(playlist_info)
             self.finish()
+            return
 
         self.spotify_session.get_playlist(link, playlist_received)
 
@@ -217,16 +310,25 @@ class RfidTagHandler(BaseHandler):
         self.spotify_session = spotify_session
 
 
+    def __forget_link(self, old_tag):
+        # the link of a tag is only kept resolved while a tag maps to it
+        if old_tag and not self.store.find_tags_by_link(old_tag.spotifylink):
+            self.spotify_session.forget_prefetched_link(old_tag.spotifylink)
+
     def delete(self, tag):
+        old_tag = self.store.find_by_tagid(tag)
         rowsdeleted = self.store.delete_tag(tag)
         if rowsdeleted == 0:
             self.set_status(404, 'Tag not found')
+        else:
+            self.__forget_link(old_tag)
 
     @tornado.web.asynchronous
     def put(self, tag):
         def link_resolved(preview):
             if preview:
                 self.store.add_tag(tag, preview.uri, preview.type, preview.image_id, preview.name)
+                self.spotify_session.prefetch_link(preview.uri)
             else:
                 self.set_status(500)
 
@@ -239,7 +341,10 @@ class RfidTagHandler(BaseHandler):
     def post(self, tag):
         def link_resolved(preview):
             if preview:
+                old_tag = self.store.find_by_tagid(tag)
                 self.store.update_tag(tag, preview.uri, preview.type, preview.image_id, preview.name)
+                self.spotify_session.prefetch_link(preview.uri)
+                self.__forget_link(old_tag)
             else:
                 self.set_status(500)
             self.finish()
@@ -249,26 +354,79 @@ class RfidTagHandler(BaseHandler):
 
 class ImageHandler(BaseHandler):
 
-    def initialize(self, spotify_session):
+    chunk_size = 64 * 1024
+
+    def initialize(self, spotify_session, image_cache):
         self.spotify_session = spotify_session
+        self.image_cache = image_cache
+
+    def set_cache_headers(self, id):
+        # image ids are content hashes, an image never changes
+        self.set_header('Etag', '"{0}"'.format(id))
+        self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+
+    def is_not_modified(self, id):
+        if_none_match = self.request.headers.get('If-None-Match')
+        return if_none_match is not None and '"{0}"'.format(id) in if_none_match
+
+    def write_file(self, id, path):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            # evicted after lookup
+            return False
+
+        with f:
+            self.set_cache_headers(id)
+            self.set_header('Content-type', 'image/jpeg')
+            self.set_header('Content-length', str(os.fstat(f.fileno()).st_size))
+
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                self.write(chunk)
+                self.flush()
+
+        return True
 
 
     @tornado.web.asynchronous
     def get(self, id):
-        def image_loaded(image, userdata):
-            if image:
-                data = image.data()
-                if data:
-                    self.set_header('Content-type', 'image/jpeg')
-                    self.set_header('Content-length', str(len(data)))
-                    self.write(str(data))
-                else:
-                    self.set_status(404)
+        def write_image(data):
+            if data:
+                self.image_cache.put(id, data)
+
+                self.set_cache_headers(id)
+                self.set_header('Content-type', 'image/jpeg')
+                self.set_header('Content-length', str(len(data)))
+                self.write(data)
             else:
                 self.set_status(404)
 
             self.finish()
 
+        def image_loaded(image, userdata):
+            data = image.data() if image else None
+
+            # caching writes to disk, keep it off the spotify event thread
+            tornado.ioloop.IOLoop.instance().add_callback(write_image, str(data) if data else None)
+
+        id = id.lower()
+
+        if self.is_not_modified(id):
+            self.set_cache_headers(id)
+            self.set_status(304)
+            self.finish()
+            return
+
+        # serve from disk when cached
+        path = self.image_cache.get_path(id)
+        if path and self.write_file(id, path):
+            self.finish()
+            return
+
         image_id = binascii.unhexlify(id)
 
         self.spotify_session.load_image(image_id, image_loaded, id)
@@ -314,6 +472,9 @@ class RfidWebSocket(tornado.websocket.WebSocketHandler):
     def on_message(self, message):
         logger.debug('[RFID] message received %s',  message)
 
+    def on_pong(self, data):
+        self.wsregistry.pong(self)
+
     def on_close(self):
         self.wsregistry.unregister_ws('rfid', self)
         logger.debug('[RFID] connection closed')
@@ -332,6 +493,9 @@ class ApplicationWebSocket(tornado.websocket.WebSocketHandler):
     def send_error(self, error_data):
         self.write_message(dict(type='error', data=error_data))
 
+    def on_pong(self, data):
+        self.wsregistry.pong(self)
+
 
     def on_message(self, message):
         msg = json.loads(message)
@@ -359,6 +523,12 @@ class ApplicationWebSocket(tornado.websocket.WebSocketHandler):
             self.spotify_session.seek(data)
         elif optype == 'player.play_track':
             self.spotify_session.play_link(data['resource_link'], data['track_link'])
+        elif optype == 'player.queue_insert':
+            self.spotify_session.insert_into_playqueue(data['link'], data.get('position'))
+        elif optype == 'player.queue_remove':
+            self.spotify_session.remove_from_playqueue(data['position'], data.get('count', 1))
+        elif optype == 'player.queue_move':
+            self.spotify_session.move_in_playqueue(data['from_position'], data['to_position'])
         else:
             self.write_message(dict(type='error', data='unknown message type {0}'.format(optype)))
 
@@ -369,6 +539,15 @@ class ApplicationWebSocket(tornado.websocket.WebSocketHandler):
         logger.debug('[Application] connection closed')
 
 
+class StatsHandler(BaseHandler):
+
+    def initialize(self, app):
+        self.app = app
+
+    def get(self):
+        self.write(self.app.get_stats())
+
+
 class WebApplication(tornado.web.Application):
 
     def __init__(self, app):
@@ -380,16 +559,19 @@ class WebApplication(tornado.web.Application):
 
         handlers = [
             # json api's
-            (r"/api/search", SearchJsonHandler, dict(spotify_session = app.spotify_session)),
+            (r"/api/search", SearchJsonHandler, dict(search_cache = app.search_cache)),
             (r"/api/playlist", PlaylistsJsonHandler, dict(spotify_session = app.spotify_session)),
-            (r"/api/playlist/(.+)", PlaylistInfoJsonHandler, dict(spotify_session = app.spotify_session)),
+            (r"/api/playlist/(.+)", PlaylistInfoJsonHandler, dict(spotify_session = app.spotify_session, metadata_cache = app.metadata_cache)),
             (r"/api/playqueue", PlayQueueHandler, dict(spotify_session = app.spotify_session)),
-            (r"/api/album/(spotify:album:\w+)", AlbumInfoJsonHandler, dict(spotify_session = app.spotify_session)),
-            (r"/api/track/(spotify:track:\w+)", TrackInfoJsonHandler, dict(spotify_session = app.spotify_session)),
+            (r"/api/playqueue/tracks", PlayQueueTracksHandler, dict(spotify_session = app.spotify_session)),
+            (r"/api/playqueue/tracks/(\d+)", PlayQueueTrackHandler, dict(spotify_session = app.spotify_session)),
+            (r"/api/album/(spotify:album:\w+)", AlbumInfoJsonHandler, dict(spotify_session = app.spotify_session, metadata_cache = app.metadata_cache)),
+            (r"/api/track/(spotify:track:\w+)", TrackInfoJsonHandler, dict(spotify_session = app.spotify_session, metadata_cache = app.metadata_cache)),
             (r"/api/rfid-linkstatus/(spotify:.+)", RfidLinkStatusHandler, dict(store=app.store)),
             (r"/api/rfid/(\w+)", RfidTagHandler, dict(store=app.store, spotify_session=app.spotify_session)),
             (r"/api/rfid", RfidTagsHandler, dict(store=app.store)),
             (r"/api/credentials", SpotifyCredentialsHandler, dict(spotify_session = app.spotify_session, app=app)),
+            (r"/api/stats", StatsHandler, dict(app=app)),
 
 
             # websockets
@@ -398,7 +580,7 @@ class WebApplication(tornado.web.Application):
 
 
             # frontend
-            (r"/image/([0-9a-fA-F]+)", ImageHandler, dict(spotify_session = app.spotify_session)),
+            (r"/image/([0-9a-fA-F]+)", ImageHandler, dict(spotify_session = app.spotify_session, image_cache = app.image_cache)),
 
 
             # static
@@ -1,64 +1,262 @@
 # -*- coding: utf-8 -*-
+import json
+import time
+import itertools
 import threading
 import logging
+from collections import OrderedDict
 from event import EventHook
 
+import tornado.ioloop
+
 logger = logging.getLogger(__name__)
 
+class WebSocketClient(object):
+
+    # keys for messages that must not be coalesced
+    unique_keys = itertools.count()
+
+    # messages that are stale by the time a lagging client would get them
+    droppable_types = frozenset(['player.playback_progress'])
+
+    def __init__(self, wstype, ws, max_pending):
+        self.wstype = wstype
+        self.ws = ws
+        self.max_pending = max_pending
+
+        # message key -> (message type, encoded frame), waiting for the socket to drain
+        self.pending = OrderedDict()
+
+        # liveness
+        self.connected = time.time()
+        self.last_pong = self.connected
+        self.ping_sent = None
+        self.round_trip_time = None
+        self.writing_since = None
+
+        # statistics
+        self.frames_sent = 0
+        self.frames_coalesced = 0
+        self.frames_dropped = 0
+        self.max_pending_seen = 0
+
+    def is_writing(self):
+        connection = self.ws.ws_connection
+        return connection is not None and connection.stream.writing()
+
+    def is_overloaded(self):
+        return len(self.pending) > self.max_pending
+
+    def is_stalled(self, now, stall_timeout):
+        return self.writing_since is not None and now - self.writing_since > stall_timeout
+
+    def send(self, msg_type, frame, coalesce=True):
+        if coalesce:
+            # a newer state message supersedes one not yet written
+            key = msg_type
+            if self.pending.pop(key, None) is not None:
+                self.frames_coalesced += 1
+        else:
+            key = (msg_type, next(self.unique_keys))
+
+        self.pending[key] = (msg_type, frame)
+        self.max_pending_seen = max(self.max_pending_seen, len(self.pending))
+
+        self.flush()
+
+        if self.is_overloaded():
+            self.__drop_stale()
+
+    def __drop_stale(self):
+        stale_keys = [key for key, (msg_type, frame) in self.pending.iteritems() if msg_type in self.droppable_types]
+
+        for key in stale_keys:
+            del self.pending[key]
+
+        self.frames_dropped += len(stale_keys)
+
+    def flush(self):
+        # only hand frames to the socket while it keeps up, the rest waits for the next flush
+        while self.pending and not self.is_writing():
+            key, (msg_type, frame) = self.pending.popitem(last=False)
+            self.ws.write_message(frame)
+            self.frames_sent += 1
+
+        if not self.is_writing():
+            self.writing_since = None
+        elif self.writing_since is None:
+            self.writing_since = time.time()
+
+    def ping(self):
+        self.ping_sent = time.time()
+        self.ws.ping('')
+
+    def pong(self):
+        self.last_pong = time.time()
+
+        if self.ping_sent is not None:
+            self.round_trip_time = self.last_pong - self.ping_sent
+            self.ping_sent = None
+
+    def stats(self):
+        request = self.ws.request
+
+        return dict(
+            type=self.wstype,
+            remote_ip=request.remote_ip if request else None,
+            connected=int(self.connected),
+            round_trip_ms=int(self.round_trip_time * 1000) if self.round_trip_time is not None else None,
+            pending=len(self.pending),
+            max_pending=self.max_pending_seen,
+            frames_sent=self.frames_sent,
+            frames_coalesced=self.frames_coalesced,
+            frames_dropped=self.frames_dropped)
+
+
 class WebSocketRegistry(object):
 
-    def __init__(self):
+    def __init__(self, flush_interval=0.05, max_pending=64, ping_interval=10, ping_timeout=30, stall_timeout=30):
         self.wsregistry = dict()
+        self.clients = dict()
         self.wsregistry_lock = threading.Lock()
         self.on_new_client = EventHook()
 
-    def register_ws(self, wstype, ws):
-        self.wsregistry_lock.acquire()
-        try:
-            socketlist = self.wsregistry.get(wstype)
-            if not socketlist:
-                socketlist = []
-                self.wsregistry[wstype] = socketlist
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.stall_timeout = stall_timeout
+        self.flush_callback = None
+        self.liveness_callback = None
 
-            socketlist.append(ws)
+        # statistics
+        self.frames_encoded = 0
+        self.evicted = 0
 
-            self.on_new_client.fire(wstype, ws)
+    def register_ws(self, wstype, ws):
+        client = WebSocketClient(wstype, ws, self.max_pending)
 
-        finally:
-            self.wsregistry_lock.release()
+        with self.wsregistry_lock:
+            self.wsregistry.setdefault(wstype, []).append(client)
+            self.clients[ws] = client
 
+        self.on_new_client.fire(wstype, ws)
 
     def unregister_ws(self, wstype, ws):
-        self.wsregistry_lock.acquire()
-        try:
-            socketlist = self.wsregistry[wstype]
-            socketlist.remove(ws)
-        finally:
-            self.wsregistry_lock.release()
+        with self.wsregistry_lock:
+            client = self.clients.pop(ws, None)
+            if client:
+                self.wsregistry[wstype].remove(client)
 
-    def broadcast(self, wstype, msg):
-        send_count = 0;
+    def has_clients(self, wstype):
+        with self.wsregistry_lock:
+            return bool(self.wsregistry.get(wstype))
+
+    def __get_clients(self, wstype=None):
+        with self.wsregistry_lock:
+            if wstype is None:
+                return self.clients.values()
+
+            return list(self.wsregistry.get(wstype, []))
+
+    def __evict(self, client, reason):
+        self.evicted += 1
+        logger.warning('Evicting websocket of type %s, %s: %s', client.wstype, reason, client.stats())
+
+        self.unregister_ws(client.wstype, client.ws)
+
+        try:
+            client.ws.close()
+        except Exception as e:
+            logger.debug('Unable to close evicted websocket: %s', repr(e))
 
-        self.wsregistry_lock.acquire()
+    def __send(self, client, msg_type, frame, coalesce):
         try:
-            erroneous_sockets = []
+            client.send(msg_type, frame, coalesce)
+
+        except Exception as e:
+            logger.exception('Error detected when sending to websocket of type %s: %s', client.wstype, str(e))
+            self.unregister_ws(client.wstype, client.ws)
+            return False
+
+        # a client that still lags after dropping stale messages is disconnected, it gets fresh state on reconnect
+        if client.is_overloaded():
+            self.__evict(client, 'too many pending messages')
+            return False
+
+        return True
+
+    def send_frame(self, ws, msg_type, frame, coalesce=True):
+        # frame is an already encoded message
+        client = self.clients.get(ws)
+        if client:
+            self.__send(client, msg_type, frame, coalesce)
+
+    def broadcast(self, wstype, msg, coalesce=True):
+        # must be called on the IOLoop, the lock is only held to copy the client list
+        clients = self.__get_clients(wstype)
+        if not clients:
+            return False
+
+        # encode once for all clients
+        frame = json.dumps(msg)
+        self.frames_encoded += 1
+
+        send_count = 0
+        for client in clients:
+            if self.__send(client, msg['type'], frame, coalesce):
+                send_count += 1
+
+        return send_count > 0
+
+    def flush(self):
+        for client in self.__get_clients():
+            try:
+                client.flush()
+            except Exception as e:
+                logger.exception('Error detected when flushing websocket of type %s: %s', client.wstype, str(e))
+                self.unregister_ws(client.wstype, client.ws)
+
+    def check_liveness(self):
+        now = time.time()
+
+        for client in self.__get_clients():
+            if now - client.last_pong > self.ping_timeout:
+                self.__evict(client, 'no pong received')
+            elif client.is_stalled(now, self.stall_timeout):
+                self.__evict(client, 'not reading')
+            else:
+                try:
+                    client.ping()
+                except Exception as e:
+                    logger.debug('Unable to ping websocket: %s', repr(e))
+                    self.unregister_ws(client.wstype, client.ws)
+
+    def pong(self, ws):
+        client = self.clients.get(ws)
+        if client:
+            client.pong()
 
-            socketlist = self.wsregistry.get(wstype)
-            if socketlist:
-                for socket in socketlist:
-                    try:
-                        socket.write_message(msg)
-                        send_count += 1
+    def start(self):
+        self.flush_callback = tornado.ioloop.PeriodicCallback(self.flush, self.flush_interval * 1000)
+        self.flush_callback.start()
 
-                    except Exception as e:
-                        logger.exception('Error detected when sending to websocket of type %s: %s', wstype, str(e))
-                        erroneous_sockets.append(socket)
+        self.liveness_callback = tornado.ioloop.PeriodicCallback(self.check_liveness, self.ping_interval * 1000)
+        self.liveness_callback.start()
 
+    def stop(self):
+        if self.flush_callback:
+            self.flush_callback.stop()
+            self.flush_callback = None
 
-                for erroneous_socket in erroneous_sockets:
-                    socketlist.remove(erroneous_socket)
+        if self.liveness_callback:
+            self.liveness_callback.stop()
+            self.liveness_callback = None
 
-        finally:
-            self.wsregistry_lock.release()
+    def stats(self):
+        clients = self.__get_clients()
 
-        return send_count > 0
\ No newline at end of file
+        return dict(
+            frames_encoded=self.frames_encoded,
+            evicted=self.evicted,
+            clients=[client.stats() for client in clients])
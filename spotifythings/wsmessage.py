@@ -2,6 +2,29 @@
 import binascii
 from spotify import Link
 
+def playqueue_item_to_dict(item):
+    return {
+        'id': item.original_index,
+        'track_name': item.track.name(),
+        'duration': item.track.duration(),
+        'link': item.link,
+        'is_available': item.track.availability() == 1,
+        'artists': [artist.name() for artist in item.track.artists()] }
+
+def playqueue_change_to_dict(change):
+    # inserted items are sent as tracks, every other change is plain data
+    if change['op'] != 'insert':
+        return change
+
+    return dict(
+        op='insert',
+        position=change['position'],
+        tracks=[playqueue_item_to_dict(item) for item in change['items']])
+
+def playqueue_changes_to_list(changes):
+    return [playqueue_change_to_dict(change) for change in changes] if changes is not None else None
+
+
 class PlayerStateMessage(dict):
      def __init__(self, state):
          super(PlayerStateMessage, self).__init__(type='player.state', data=state)
@@ -25,8 +48,10 @@ class PlayerPlaybackProgressMessage(dict):
 
 
 class PlayerQueueModifiedMessage(dict):
-     def __init__(self):
-         super(PlayerQueueModifiedMessage, self).__init__(type='player.queue_modified')
+     def __init__(self, from_version, version, changes):
+         super(PlayerQueueModifiedMessage, self).__init__(
+             type='player.queue_modified',
+             data = dict(from_version=from_version, version=version, changes=playqueue_changes_to_list(changes)))
 
 class SpotifyLoginStateMessage(dict):
      def __init__(self, is_logged_in, login_error, current_user):
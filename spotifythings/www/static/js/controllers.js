@@ -502,19 +502,96 @@ adminControllers.controller('TrackInfoCtrl', function ($scope, $rootScope, $elem
 
 adminControllers.controller('PlayQueueCtrl', function ($scope, $rootScope, SpotifyService, PlayerService) {
 
-    function updatePlayQueue()
+    // version of the queue shown, null until the first fetch completed
+    var version = null;
+
+    $scope.tracks = [];
+    $scope.currentPosition = -1;
+
+    function applyChanges(changes)
+    {
+        for (var i = 0; i < changes.length; i++) {
+            var change = changes[i];
+
+            if (change.op == 'reset') {
+                // the queue was replaced, fetch it all
+                return false;
+            }
+            else if (change.op == 'order') {
+                // back to the unshuffled order, given as track ids
+                var tracksById = {};
+                for (var j = 0; j < $scope.tracks.length; j++) {
+                    tracksById[$scope.tracks[j].id] = $scope.tracks[j];
+                }
+
+                $scope.tracks = change.order.map(function (id) {
+                    return tracksById[id];
+                });
+            }
+            else if (change.op == 'swap') {
+                var track = $scope.tracks[change.positions[0]];
+                $scope.tracks[change.positions[0]] = $scope.tracks[change.positions[1]];
+                $scope.tracks[change.positions[1]] = track;
+            }
+            else if (change.op == 'insert') {
+                Array.prototype.splice.apply($scope.tracks, [change.position, 0].concat(change.tracks));
+            }
+            else if (change.op == 'remove') {
+                $scope.tracks.splice(change.position, change.count);
+            }
+            else if (change.op == 'move') {
+                var moved = $scope.tracks.splice(change.from_position, 1)[0];
+                $scope.tracks.splice(change.to_position, 0, moved);
+            }
+            else if (change.op == 'current') {
+                $scope.currentPosition = change.position;
+            }
+        }
+
+        return true;
+    }
+
+    function updatePlayQueue(sinceVersion)
     {
-        SpotifyService.getPlayQueue(function (tracks) {
-            $scope.tracks = tracks;
+        SpotifyService.getPlayQueue(sinceVersion, function (data) {
+            if (data.changes) {
+                if (!applyChanges(data.changes)) {
+                    updatePlayQueue(null);
+                    return;
+                }
+            }
+            else {
+                $scope.tracks = data.result;
+                $scope.currentPosition = data.current;
+            }
+
+            version = data.version;
         });
     }
 
+    function playQueueModified(modification)
+    {
+        // not loaded yet or missed changes, catch up from the server
+        if (version === null || modification.from_version != version || modification.changes === null) {
+            updatePlayQueue(version);
+            return;
+        }
+
+        if (!applyChanges(modification.changes)) {
+            version = null;
+            updatePlayQueue(null);
+            return;
+        }
+
+        version = modification.version;
+    }
+
     $scope.player = new TrackCollectionPlayer(PlayerService);
     $scope.$on('$destroy', $scope.player.destroy);
 
-    $scope.$on('$destroy', PlayerService.subscribePlayQueueChanged(updatePlayQueue));
+    $scope.$on('$destroy', PlayerService.subscribePlayQueueChanged(playQueueModified));
 
-    updatePlayQueue();
+    updatePlayQueue(null);
 		
 });
 
@@ -88,9 +88,11 @@ adminServices.service('SpotifyService', function($http, MessageService) {
             });
         };
 
-        this.getPlayQueue = function (callback) {
-            $http.get('/api/playqueue').success(function(data) {
-                callback(data.result);
+        this.getPlayQueue = function (sinceVersion, callback) {
+            var params = sinceVersion !== null ? { since: sinceVersion } : {};
+
+            $http.get('/api/playqueue', { params: params }).success(function(data) {
+                callback(data);
             });
         };
 
@@ -216,11 +218,7 @@ adminServices.service('MessageService', function($http, $rootScope, $timeout, Ho
     };
 
 
-    ws.onmessage = function (evt) {
-        log(evt.data);
-
-
-        var message = $.parseJSON(evt.data);
+    function handleMessage(message) {
         var type = message.type;
         var payload = message.data;
 
@@ -231,6 +229,21 @@ adminServices.service('MessageService', function($http, $rootScope, $timeout, Ho
         $timeout(function () {
             $rootScope.$emit(type, payload);
         });
+    }
+
+    ws.onmessage = function (evt) {
+        log(evt.data);
+
+
+        var message = $.parseJSON(evt.data);
+
+        // state sent on connect, one message per state type
+        if (message.type == 'snapshot') {
+            angular.forEach(message.data, handleMessage);
+        }
+        else {
+            handleMessage(message);
+        }
 
     };
 
@@ -281,6 +294,18 @@ adminServices.service('PlayerService', function($http, $rootScope, MessageServic
         MessageService.sendMessage('player.seek', offset)
     }
 
+    this.queueInsert = function(link, position) {
+        MessageService.sendMessage('player.queue_insert', { link: link, position: position });
+    };
+
+    this.queueRemove = function(position, count) {
+        MessageService.sendMessage('player.queue_remove', { position: position, count: count || 1 });
+    };
+
+    this.queueMove = function(fromPosition, toPosition) {
+        MessageService.sendMessage('player.queue_move', { from_position: fromPosition, to_position: toPosition });
+    };
+
 
     // subcribtions
     this.updatePlayerState = function(handler) {